@@ -0,0 +1,19 @@
+"""Import cost of filigree: plot data computations must not import Bokeh or SciPy"""
+import subprocess
+import sys
+
+HEAVY = ('bokeh', 'scipy')
+CODE = "import filigree; from filigree import qhistograms, box_plots; import filigree.smoothers"
+
+
+class Import:
+    def timeraw_import_filigree(self):
+        return CODE
+
+    def track_heavy_modules_on_import(self):
+        """Number of Bokeh and SciPy modules loaded by importing the plot data API, expected 0"""
+        out = subprocess.check_output(
+            [sys.executable, '-c', f"{CODE}; import sys; print(sum(m.split('.')[0] in {HEAVY!r} for m in sys.modules))"],
+            text=True)
+        return int(out)
+    track_heavy_modules_on_import.unit = 'modules'
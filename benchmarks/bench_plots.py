@@ -0,0 +1,93 @@
+"""Plot data structures: lattice.qhistograms, lattice.box_plots and lattice.histogram2d"""
+import os
+import pickle
+import tempfile
+
+import pandas as pd
+
+from filigree import storage
+from filigree.lattice import qhistograms, box_plots, histogram2d, batch_plots
+
+from .generators import make_frame, make_xy
+
+
+class GroupedPlots:
+    params = ([10 ** 3, 10 ** 5, 10 ** 7], [1, 100, 10 ** 4], ['normal', 'lognormal'], ['lists', 'arrays'])
+    param_names = ['rows', 'groups', 'dist', 'layout']
+    timeout = 600
+
+    def setup(self, rows, groups, dist, layout):
+        if groups > rows:
+            raise NotImplementedError  # skipped
+        self.df = make_frame(rows, groups, dist=dist)
+
+    def time_qhistograms(self, rows, groups, dist, layout):
+        qhistograms(self.df, 'g', 'v', layout=layout)
+
+    def peakmem_qhistograms(self, rows, groups, dist, layout):
+        qhistograms(self.df, 'g', 'v', layout=layout)
+
+    def time_box_plots(self, rows, groups, dist, layout):
+        box_plots(self.df, 'g', 'v', layout=layout)
+
+    def peakmem_box_plots(self, rows, groups, dist, layout):
+        box_plots(self.df, 'g', 'v', layout=layout)
+
+
+class BatchPlots:
+    params = ([10 ** 5, 10 ** 6], [10, 100])
+    param_names = ['rows', 'columns']
+    timeout = 600
+
+    def setup(self, rows, columns):
+        df = make_frame(rows, 100)
+        self.cols = [f'v{i}' for i in range(columns)]
+        self.df = pd.concat([df, pd.DataFrame({col: df['v'].to_numpy() * (i + 1) for i, col in enumerate(self.cols)},
+                                              index=df.index)], axis=1)
+
+    def time_batch_plots(self, rows, columns):
+        batch_plots(self.df, 'g', self.cols)
+
+    def time_loop(self, rows, columns):
+        for col in self.cols:
+            qhistograms(self.df, 'g', col)
+            box_plots(self.df, 'g', col)
+
+
+class SavedPlots:
+    params = ([100, 10 ** 4], )
+    param_names = ['groups']
+
+    def setup(self, groups):
+        df = make_frame(10 ** 6, groups)
+        self.data = {'qhistograms': qhistograms(df, 'g', 'v'), 'box_plots': box_plots(df, 'g', 'v')}
+        self.dir = tempfile.mkdtemp()
+        self.npz = os.path.join(self.dir, 'plots.npz')
+        self.pkl = os.path.join(self.dir, 'plots.pkl')
+        storage.save(self.npz, self.data)
+        with open(self.pkl, 'wb') as f:
+            pickle.dump(self.data, f)
+
+    def time_load_mmap(self, groups):
+        storage.load(self.npz)
+
+    def time_load_pickle(self, groups):
+        with open(self.pkl, 'rb') as f:
+            pickle.load(f)
+
+    def time_save(self, groups):
+        storage.save(self.npz, self.data)
+
+
+class Histogram2d:
+    params = ([10 ** 3, 10 ** 5, 10 ** 7], [10, 100, 1000], [False, True])
+    param_names = ['rows', 'grid', 'merge']
+
+    def setup(self, rows, grid, merge):
+        self.x, self.y = make_xy(rows)
+
+    def time_histogram2d(self, rows, grid, merge):
+        histogram2d(self.x, self.y, bins=(grid, grid), merge=merge)
+
+    def peakmem_histogram2d(self, rows, grid, merge):
+        histogram2d(self.x, self.y, bins=(grid, grid), merge=merge)
@@ -0,0 +1,46 @@
+"""Smoothers: smoothers.MetricSmoother and smoothers.NormalSmoother"""
+import numpy as np
+
+from filigree.metrics import Quantile, SigmaOffset, PortionInRadius
+from filigree.smoothers import MetricSmoother, NormalSmoother
+
+from .generators import make_xy
+
+METRICS = {'quantile': Quantile(.9), 'sigma_offset': SigmaOffset(1), 'portion': PortionInRadius(.1)}
+
+
+class MetricSmoothers:
+    params = ([10 ** 3, 10 ** 5, 10 ** 7], [100, 2000], list(METRICS))
+    param_names = ['rows', 'grid', 'metric']
+    timeout = 600
+
+    def setup(self, rows, grid, metric):
+        x, y = make_xy(rows)
+        self.smoother = MetricSmoother(x, y, METRICS[metric])
+        self.grid = np.linspace(0, 10, grid)
+
+    def time_metric_smoother(self, rows, grid, metric):
+        self.smoother(self.grid)
+
+    def peakmem_metric_smoother(self, rows, grid, metric):
+        self.smoother(self.grid)
+
+
+class NormalSmoothers:
+    params = ([10 ** 3, 10 ** 5, 10 ** 7], [100, 2000], ['exact', 'truncated', 'binned'])
+    param_names = ['rows', 'grid', 'mode']
+    timeout = 600
+
+    def setup(self, rows, grid, mode):
+        if mode == 'exact' and rows * grid > 10 ** 9:
+            raise NotImplementedError  # skipped
+        x, y = make_xy(rows)
+        kwargs = {'exact': {}, 'truncated': {'truncate': 4}, 'binned': {'bins': 4096}}[mode]
+        self.smoother = NormalSmoother(x, y, window=.05, **kwargs)
+        self.grid = np.linspace(0, 10, grid)
+
+    def time_normal_smoother(self, rows, grid, mode):
+        self.smoother(self.grid)
+
+    def peakmem_normal_smoother(self, rows, grid, mode):
+        self.smoother(self.grid)
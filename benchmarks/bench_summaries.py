@@ -0,0 +1,51 @@
+"""Grouped summaries: tools.calculate_quantiles, fretwork.calculate_boxes and metrics"""
+import numpy as np
+
+from filigree.fretwork import calculate_boxes
+from filigree.metrics import MetricSet, Quantile, QuantileRange, SigmaRadius, PortionInRadius
+from filigree.tools import calculate_quantiles, calculate_metrics
+
+from .generators import make_frame
+
+
+class GroupedSummaries:
+    params = ([10 ** 3, 10 ** 5, 10 ** 7], [1, 100, 10 ** 5], ['normal', 'pareto'], [0., 1.2])
+    param_names = ['rows', 'groups', 'dist', 'skew']
+    timeout = 600
+
+    def setup(self, rows, groups, dist, skew):
+        if groups > rows:
+            raise NotImplementedError  # skipped
+        self.df = make_frame(rows, groups, dist=dist, skew=skew)
+        self.quantiles = np.arange(0.25, .8, .05)
+
+    def time_calculate_quantiles(self, rows, groups, dist, skew):
+        calculate_quantiles(self.df, 'g', 'v', quantiles=self.quantiles)
+
+    def peakmem_calculate_quantiles(self, rows, groups, dist, skew):
+        calculate_quantiles(self.df, 'g', 'v', quantiles=self.quantiles)
+
+    def time_calculate_boxes(self, rows, groups, dist, skew):
+        calculate_boxes(self.df, 'g', 'v')
+
+    def peakmem_calculate_boxes(self, rows, groups, dist, skew):
+        calculate_boxes(self.df, 'g', 'v')
+
+
+class Metrics:
+    params = ([10 ** 3, 10 ** 5, 10 ** 7], [1, 1000])
+    param_names = ['rows', 'groups']
+
+    def setup(self, rows, groups):
+        self.df = make_frame(rows, groups)
+        self.metrics = MetricSet(Quantile(.1), Quantile(.9), QuantileRange(.25, .75),
+                                 SigmaRadius(1), PortionInRadius(2))
+
+    def time_metric_set(self, rows, groups):
+        self.metrics(self.df.v.values)
+
+    def time_calculate_metrics(self, rows, groups):
+        calculate_metrics(self.df, 'g', 'v', self.metrics)
+
+    def peakmem_calculate_metrics(self, rows, groups):
+        calculate_metrics(self.df, 'g', 'v', self.metrics)
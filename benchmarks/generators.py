@@ -0,0 +1,45 @@
+"""Synthetic data for the benchmarks"""
+import numpy as np
+import pandas as pd
+
+DISTRIBUTIONS = ('normal', 'lognormal', 'pareto', 'bimodal')
+
+
+def make_values(rows, dist='normal', rng=None):
+    rng = np.random.default_rng(0) if rng is None else rng
+    if dist == 'normal':
+        return rng.standard_normal(rows)
+    if dist == 'lognormal':
+        return rng.lognormal(sigma=1.5, size=rows)
+    if dist == 'pareto':
+        return rng.pareto(1.5, size=rows)
+    if dist == 'bimodal':
+        return rng.standard_normal(rows) + 4 * (rng.uniform(size=rows) < 0.3)
+    raise ValueError(f"unknown distribution {dist}")
+
+def make_frame(rows, groups, dist='normal', skew=0., seed=0):
+    """DataFrame with an integer group column 'g' and a value column 'v'
+
+        Args:
+            rows, int: number of records
+            groups, int: number of distinct groups (at most rows)
+            dist, str: distribution of values, one of DISTRIBUTIONS
+            skew, float: 0 gives equally likely groups, larger values give group sizes
+                     falling off as rank ** -skew (Zipf like)
+            seed, int: random seed
+    """
+    rng = np.random.default_rng(seed)
+    groups = min(groups, rows)
+    p = np.arange(1, groups + 1, dtype=float) ** -skew
+    g = rng.choice(groups, size=rows, p=p / p.sum())
+    # every group gets at least one record
+    g[:groups] = np.arange(groups)
+
+    return pd.DataFrame({'g': g, 'v': make_values(rows, dist, rng)})
+
+def make_xy(rows, dist='normal', seed=0):
+    """x uniform on [0, 10) and y = sin(x) plus noise from `dist`"""
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(0, 10, rows)
+
+    return x, np.sin(x) + 0.1 * make_values(rows, dist, rng)
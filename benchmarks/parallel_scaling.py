@@ -0,0 +1,42 @@
+"""Scaling benchmark of filigree.parallel against the single process summaries
+
+    python -m benchmarks.parallel_scaling --rows 10000000 --groups 5000 --workers 1 2 4 8
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from filigree.fretwork import calculate_boxes
+from filigree.parallel import parallel_calculate_boxes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10 ** 7)
+    parser.add_argument('--groups', type=int, default=5000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count()])
+    parser.add_argument('--exact-limit', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    df = pd.DataFrame({'g': rng.integers(0, args.groups, args.rows),
+                       'v': rng.standard_normal(args.rows)})
+
+    t = time.perf_counter()
+    calculate_boxes(df, 'g', 'v')
+    base = time.perf_counter() - t
+    print(f"{'workers':>8} {'seconds':>9} {'speedup':>8}")
+    print(f"{'serial':>8} {base:9.3f} {1:8.2f}")
+    for n in sorted(set(args.workers)):
+        t = time.perf_counter()
+        parallel_calculate_boxes(df, 'g', 'v', n_workers=n, exact_limit=args.exact_limit)
+        dt = time.perf_counter() - t
+        print(f"{n:>8} {dt:9.3f} {base / dt:8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Run the benchmarks without asv and keep results per commit
+
+    python -m benchmarks.run                          # everything
+    python -m benchmarks.run -b qhistograms --max-rows 100000
+    python -m benchmarks.run --compare HEAD~1         # ratio to the results of another commit
+
+The benchmark classes follow asv conventions (params, param_names, setup, time_*, timeraw_*,
+peakmem_* and track_* methods), so `asv run` uses the same suite. time_* report the best wall
+time of --repeat runs, timeraw_* the best time of running the returned code in a fresh
+interpreter, peakmem_* the peak of memory allocated during the call (tracemalloc, which
+numpy reports its array buffers to) and track_* the returned value. Results are written to
+.benchmarks/<commit>.json.
+"""
+import argparse
+import importlib
+import itertools
+import json
+import os
+import pkgutil
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+
+RESULTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.benchmarks')
+
+
+def _commit(rev='HEAD'):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', rev], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def _benchmarks():
+    package = importlib.import_module('benchmarks')
+    for info in pkgutil.iter_modules(package.__path__):
+        if not info.name.startswith('bench_'):
+            continue
+        module = importlib.import_module(f'benchmarks.{info.name}')
+        for name, cls in list(vars(module).items()):
+            if isinstance(cls, type) and cls.__module__ == module.__name__:
+                for method in dir(cls):
+                    if method.startswith(('time_', 'timeraw_', 'peakmem_', 'track_')):
+                        yield cls, method
+
+def _measure(func, args, kind, repeat):
+    if kind == 'track':
+        return func(*args)
+    if kind == 'timeraw':
+        code = func(*args)
+        func = lambda *args: subprocess.check_call([sys.executable, '-c', code])
+    if kind == 'peakmem':
+        tracemalloc.start()
+        try:
+            func(*args)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - t)
+    return best
+
+def run(pattern='', max_rows=None, repeat=3):
+    results = {}
+    for cls, method in _benchmarks():
+        name = f'{cls.__name__}.{method}'
+        if not re.search(pattern, name):
+            continue
+        params = getattr(cls, 'params', [()])
+        names = getattr(cls, 'param_names', [])
+        for args in itertools.product(*params) if names else [()]:
+            kwargs = dict(zip(names, args))
+            if max_rows is not None and kwargs.get('rows', 0) > max_rows:
+                continue
+            bench = cls()
+            try:
+                if hasattr(bench, 'setup'):
+                    bench.setup(*args)
+            except NotImplementedError:
+                continue
+            value = _measure(getattr(bench, method), args, method.split('_')[0], repeat)
+            key = f"{name}({', '.join(f'{k}={v}' for k, v in kwargs.items())})"
+            results[key] = value
+            unit = getattr(getattr(bench, method), 'unit', 'B' if method.startswith('peakmem_') else 's')
+            print(f'{key:<90} {value:12.6g} {unit}', flush=True)
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-b', '--bench', default='', help='regex selecting Class.method names')
+    parser.add_argument('--max-rows', type=int, default=None, help='skip cases with more rows')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--compare', default=None, help='commit whose stored results to compare against')
+    parser.add_argument('--threshold', type=float, default=1.2, help='ratio reported as a regression')
+    args = parser.parse_args()
+
+    results = run(args.bench, max_rows=args.max_rows, repeat=args.repeat)
+    os.makedirs(RESULTS, exist_ok=True)
+    path = os.path.join(RESULTS, f'{_commit()}.json')
+    stored = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            stored = json.load(f)
+    stored.update(results)
+    with open(path, 'w') as f:
+        json.dump(stored, f, indent=1, sort_keys=True)
+
+    if args.compare is not None:
+        with open(os.path.join(RESULTS, f'{_commit(args.compare)}.json')) as f:
+            base = json.load(f)
+        print(f'\ncompared to {args.compare} (ratio new / old)')
+        for key in sorted(set(results) & set(base)):
+            ratio = results[key] / base[key] if base[key] else (float('inf') if results[key] else 1.)
+            flag = '  REGRESSION' if ratio > args.threshold else ''
+            print(f'{key:<90} {ratio:8.2f}{flag}')
+
+
+if __name__ == '__main__':
+    main()
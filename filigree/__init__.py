@@ -1,3 +1,33 @@
-from filigree.colors import get_colors_hex
-from filigree.fretwork import qhistograms, box_plots
-from filigree.ornaments import scatter_matrix
+"""Create complex plot data structures (plottable with Bokeh) from Pandas DataFrames
+
+Submodules and the names below are imported on first use (PEP 562), so computing plot data
+does not pay for importing Bokeh's plotting stack or SciPy.
+"""
+import importlib
+
+_exports = {'get_colors_hex': 'filigree.colors',
+            'qhistograms': 'filigree.lattice',
+            'box_plots': 'filigree.lattice',
+            'batch_plots': 'filigree.lattice',
+            'slice_heatmap': 'filigree.lattice',
+            'scatter_matrix': 'filigree.ornaments'}
+
+_submodules = {'bootstrap', 'cache', 'colors', 'fretwork', 'lattice', 'live', 'metrics', 'ornaments', 'parallel',
+               'profiling', 'sketches', 'smoothers', 'storage', 'tools'}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(importlib.import_module(_exports[name]), name)
+    elif name in _submodules:
+        value = importlib.import_module(f'filigree.{name}')
+    else:
+        raise AttributeError(f"module 'filigree' has no attribute {name!r}")
+    globals()[name] = value
+
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports) | _submodules)
@@ -0,0 +1,186 @@
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from filigree.profiling import profiled
+from filigree.tools import group_sort
+
+
+def _strata(offsets):
+    """Start and size of the segment of every record, the strata resampled within"""
+    sizes = np.diff(offsets)
+    return np.repeat(offsets[:-1], sizes), np.repeat(sizes, sizes)
+
+def replicate_counts(n_replicates, starts, sizes, method='multinomial', rng=None):
+    """How many times every record is drawn in each bootstrap replicate, drawn as one array
+
+        Args:
+            starts, sizes, np.array(int): first record and size of the stratum of every record,
+                     each stratum is resampled to its size (method='multinomial')
+            method, str: 'multinomial' draws len(starts) resample indices per replicate at once
+                     and counts them, 'poisson' draws independent Poisson(1) counts (faster,
+                     replicate sizes vary)
+
+        return: np.array(int) of shape (n_replicates, n_records)
+    """
+    rng = np.random.default_rng(rng)
+    n = len(starts)
+    if method == 'poisson':
+        return rng.poisson(1., (n_replicates, n))
+    assert method == 'multinomial', method
+    idx = starts + (rng.random((n_replicates, n)) * sizes).astype(np.int64)
+    idx += np.arange(n_replicates).reshape(-1, 1) * n
+
+    return np.bincount(idx.ravel(), minlength=n_replicates * n).reshape(n_replicates, n)
+
+def _replicate_chunk(metric, values, offsets, index, starts, sizes, n_replicates, method, seed):
+    """Metric of every segment in n_replicates replicates, np.array of shape (n_replicates, n_segments)
+
+        Segment i is values[offsets[i]:offsets[i + 1]], records index[offsets[i]:offsets[i + 1]]
+        of the resampled data. All replicates are evaluated as the segments of one array
+        with the replicate counts as weights (see metrics.SegmentStats).
+    """
+    counts = replicate_counts(n_replicates, starts, sizes, method=method, rng=seed)
+    weights = counts if index is None else counts[:, index]
+    shift = (np.arange(n_replicates) * len(values)).reshape(-1, 1)
+    tiled = np.concatenate([(offsets[:-1] + shift).ravel(), [n_replicates * len(values)]])
+    out = metric.segments(np.tile(values, n_replicates), tiled, weights=weights.ravel())
+
+    return np.asarray(out, dtype=float).reshape(n_replicates, -1)
+
+def _replicate_windows(metric, values, starts, ends, n_replicates, method, seed):
+    """Metric of every window values[starts[i]:ends[i]] in n_replicates replicates of all records,
+        np.array of shape (n_replicates, n_windows)
+
+        Each replicate is one metric.windows call with the replicate counts as weights, from
+        weighted prefix sums in O(len(values) + n_windows) for metrics with _weighted_windows.
+    """
+    n = len(values)
+    counts = replicate_counts(n_replicates, np.zeros(n, dtype=np.int64), np.full(n, n), method=method, rng=seed)
+    out = [metric.windows(values, starts, ends, weights=c) for c in counts]
+
+    return np.asarray(out, dtype=float).reshape(n_replicates, len(starts))
+
+def _replicates(chunk, args, n_values, n_replicates, method, chunk_size, n_workers, seed):
+    """np.array of shape (n_replicates, ...) of chunk(*args, n, method, seed) run on chunks of n
+        replicates of at most chunk_size weighted values each. Chunks are seeded from `seed` in
+        order, so results do not depend on n_workers.
+    """
+    step = max(chunk_size // max(n_values, 1), 1)
+    sizes = [min(step, n_replicates - a) for a in range(0, n_replicates, step)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    calls = [args + (b, method, s) for b, s in zip(sizes, seeds)]
+    if n_workers is None:
+        parts = [chunk(*c) for c in calls]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count()) as pool:
+            parts = list(pool.map(chunk, *zip(*calls)))
+
+    return np.concatenate(parts)
+
+def _band(estimate, replicates, ci):
+    """Percentile band of coverage ci of the replicates (first axis) around an estimate"""
+    alpha = (1 - ci) / 2
+    with warnings.catch_warnings():
+        # segments empty in every replicate (e.g. windows without data) stay nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lower, upper = np.nanquantile(replicates, [alpha, 1 - alpha], axis=0)
+
+    return {'estimate': np.asarray(estimate, dtype=float), 'lower': lower, 'upper': upper}
+
+@profiled('aggregation')
+def bootstrap_segments(metric, values, offsets, n_replicates=1000, ci=.95, method='multinomial', index=None,
+                       strata=None, chunk_size=2 ** 24, n_workers=None, seed=0):
+    """Percentile bootstrap confidence band of a metric on every segment values[offsets[i]:offsets[i + 1]]
+        of values sorted within segments (as tools.group_sort returns them)
+
+        Replicates are processed in chunks of at most chunk_size weighted values, each chunk
+        evaluated in one metric.segments call. Chunks are seeded from `seed` in order, so
+        results do not depend on n_workers.
+
+        Args:
+            metric, filigree.metrics instance: the built in metrics (SigmaOffset, SigmaRadius,
+                     Quantile, QuantileRange, PortionInBounds, PortionInRadius) evaluate all
+                     replicates with weighted segment reductions. Custom ABCMetric subclasses
+                     work too: with a __call__(s, weights=None) they are called with the counts,
+                     otherwise with every segment repeated by its counts, once per segment and
+                     replicate, which is much slower
+            ci, float: coverage of the band
+            method, str: 'multinomial' or 'poisson', see replicate_counts
+            index, np.array(int): default None, segment values are values of records
+                     index[offsets[i]:offsets[i + 1]] (overlapping segments, e.g. windows)
+            strata, tuple: (starts, sizes) of the resampled records, default resamples every
+                     segment within itself (or all records, when index is given)
+            n_workers, int: default None evaluates in this process, otherwise chunks are
+                     spread across a process pool of n_workers
+
+        return: dict of np.arrays 'estimate', 'lower', 'upper' with a value per segment
+    """
+    values = np.asarray(values, dtype=float)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if strata is None and index is None:
+        strata = _strata(offsets)
+    elif strata is None:
+        n = int(index.max()) + 1 if len(index) else 0
+        strata = (np.zeros(n, dtype=np.int64), np.full(n, n))
+    starts, sizes = strata
+    replicates = _replicates(_replicate_chunk, (metric, values, offsets, index, starts, sizes), len(values),
+                             n_replicates, method, chunk_size, n_workers, seed)
+
+    return _band(metric.segments(values, offsets), replicates, ci)
+
+def bootstrap_metric(df, by, col, metric, **kwargs):
+    """Bootstrap confidence band of a metric of `col` in every group of `by` (groups resampled
+        within themselves), e.g. for the per-group values of box plots and quantile histograms,
+        see bootstrap_segments for kwargs
+
+        return: pandas.DataFrame indexed by group with columns estimate, lower, upper
+    """
+    groups, values, offsets = group_sort(df[by], df[col])
+
+    return pd.DataFrame(bootstrap_segments(metric, values, offsets, **kwargs), index=pd.Index(groups, name=by))
+
+def _explicit_windows(metric, ys, starts, ends, **kwargs):
+    """bootstrap_segments of the windows ys[starts[i]:ends[i]] laid out back to back"""
+    lens = ends - starts
+    offsets = np.concatenate([[0], np.cumsum(lens)])
+    # records of all windows back to back, sorted by value within each window
+    index = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - starts, lens)
+    index = index[np.lexsort((ys[index], np.repeat(np.arange(len(starts)), lens)))]
+    n = len(ys)
+    strata = (np.zeros(n, dtype=np.int64), np.full(n, n))
+
+    return bootstrap_segments(metric, ys[index], offsets, index=index, strata=strata, **kwargs)
+
+def bootstrap_smoother(smoother, x, n_replicates=1000, ci=.95, method='multinomial', chunk_size=2 ** 24,
+                       n_workers=None, seed=0):
+    """Bootstrap confidence band of a smoothers.MetricSmoother curve at x, resampling the data
+        records once per replicate for all windows, see bootstrap_segments for the arguments
+
+        Moment and portion metrics (SigmaOffset, SigmaRadius, PortionInBounds, PortionInRadius)
+        evaluate each replicate with the smoother's sorted windows, weighted by the replicate
+        counts, in O(n_records + len(x)) memory and time. Other metrics lay the records of all
+        windows out back to back, sum(window sizes) values per replicate.
+
+        return: dict of np.arrays 'estimate', 'lower', 'upper' aligned with x
+    """
+    x = np.asarray(x, dtype=float)
+    order = np.argsort(x, kind='stable')
+    starts, ends = smoother.window_bounds(x[order])
+    ys = np.asarray(smoother._ys, dtype=float)
+    if smoother.metric._weighted_windows:
+        replicates = _replicates(_replicate_windows, (smoother.metric, ys, starts, ends), len(ys) + len(x),
+                                 n_replicates, method, chunk_size, n_workers, seed)
+        bands = _band(smoother.metric.windows(ys, starts, ends), replicates, ci)
+    else:
+        bands = _explicit_windows(smoother.metric, ys, starts, ends, n_replicates=n_replicates, ci=ci,
+                                  method=method, chunk_size=chunk_size, n_workers=n_workers, seed=seed)
+    out = {}
+    for k, v in bands.items():
+        out[k] = np.empty(len(x))
+        out[k][order] = v
+
+    return out
@@ -0,0 +1,153 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from filigree.fretwork import calculate_boxes, boxes_from_quantiles
+from filigree.tools import calculate_quantiles, quantile_label
+
+QUARTILES = tuple(quantile_label(q) for q in (.25, .5, .75))
+
+
+def fingerprint(df, columns, sample=1024):
+    """Cheap fingerprint of DataFrame columns: length, dtypes and a hash of `sample` evenly spaced rows
+
+        Changes to rows outside the sample are not detected, call SummaryCache.invalidate
+        after modifying a DataFrame in place.
+    """
+    columns = list(columns)
+    rows = np.unique(np.linspace(0, len(df) - 1, min(len(df), sample)).astype(np.int64))
+    hashed = pd.util.hash_pandas_object(df[columns].iloc[rows], index=True).to_numpy()
+
+    return (len(df), tuple(columns), tuple(str(df[c].dtype) for c in columns),
+            hashlib.sha1(hashed.tobytes()).hexdigest())
+
+
+class SummaryCache(object):
+    """LRU cache of grouped summary tables shared across plot builders
+
+        Quantile tables (tools.calculate_quantiles) and box tables (fretwork.calculate_boxes) are
+        keyed by a fingerprint of df[[by, col]] (and the weights column), `by`, `col`, the weights
+        column and the quantile set or `outlier_r`.
+        Compatible entries are reused: a quantile set is read from any cached superset, and box
+        tables are derived from a cached quantile table holding the quartiles or from a box
+        table with a different `outlier_r`.
+
+        Args:
+            maxsize, int: maximum number of cached tables
+            max_bytes, int: default None, maximum memory of cached tables
+
+        Example:
+            cache = SummaryCache()
+            box_plots(df, 'hour', 'residual', cache=cache)
+            qhistograms(df, 'hour', 'residual', cache=cache)
+            cache.stats()
+    """
+    def __init__(self, maxsize=32, max_bytes=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return sum(int(v.memory_usage(index=True).sum()) for v in self._entries.values())
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': len(self), 'bytes': self.nbytes}
+
+    def _get(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def _put(self, key, table):
+        self._entries[key] = table
+        while len(self._entries) > self.maxsize or (
+                self.max_bytes is not None and len(self._entries) > 1 and self.nbytes > self.max_bytes):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    @staticmethod
+    def _kind(kind, weights):
+        # weighted tables are kept apart, with the weights column named in their kind
+        return kind if weights is None else f'{kind}:{weights}'
+
+    @staticmethod
+    def _columns(by, col, kind):
+        weights = kind.partition(':')[2]
+        return [by, col] + ([weights] if weights else [])
+
+    def _find(self, fp, by, col, kind, test):
+        for (fp_, by_, col_, kind_, params), table in reversed(self._entries.items()):
+            if (fp_, by_, col_, kind_) == (fp, by, col, kind) and test(params):
+                self._entries.move_to_end((fp_, by_, col_, kind_, params))
+                return params, table
+        return None, None
+
+    def quantiles(self, df, by, col, quantiles=(.25, .5, .75), weights=None):
+        """tools.calculate_quantiles, from the cache when a superset of `quantiles` is cached
+        """
+        kind = self._kind('quantiles', weights)
+        fp = fingerprint(df, self._columns(by, col, kind))
+        labels = tuple(quantile_label(q) for q in quantiles)
+        _, table = self._find(fp, by, col, kind, lambda params: set(labels) <= set(params))
+        if table is not None:
+            self.hits += 1
+            return table[['qmin', 'qmax', 'qmedian', 'mu', 'n_records'] + list(labels)].copy()
+
+        self.misses += 1
+        table = calculate_quantiles(df, by, col, quantiles=quantiles, weights=weights)
+        self._put((fp, by, col, kind, labels), table)
+
+        return table.copy()
+
+    def boxes(self, df, by, col, outlier_r=1.5, weights=None):
+        """fretwork.calculate_boxes, from the cache when the quartiles are cached
+        """
+        kind = self._kind('boxes', weights)
+        fp = fingerprint(df, self._columns(by, col, kind))
+        table = self._get((fp, by, col, kind, outlier_r))
+        if table is None:
+            _, table = self._find(fp, by, col, kind, lambda params: True)
+            if table is not None:
+                table = table.assign(lower=lambda x: x.q1 - x.iqr * outlier_r,
+                                     upper=lambda x: x.q3 + x.iqr * outlier_r)
+        if table is None:
+            _, qt = self._find(fp, by, col, self._kind('quantiles', weights),
+                               lambda params: set(QUARTILES) <= set(params))
+            if qt is not None:
+                table = boxes_from_quantiles(qt, outlier_r=outlier_r)
+        if table is not None:
+            self.hits += 1
+            return table.copy()
+
+        self.misses += 1
+        table = calculate_boxes(df, by, col, outlier_r=outlier_r, weights=weights)
+        self._put((fp, by, col, kind, outlier_r), table)
+
+        return table.copy()
+
+    def invalidate(self, df=None, by=None, col=None):
+        """Drop cached tables, all of them by default or only those of `df` (and `by`, `col`)
+        """
+        if df is None:
+            self._entries.clear()
+            return
+        for key in list(self._entries):
+            fp, by_, col_, kind, _ = key
+            columns = self._columns(by_, col_, kind)
+            if ((by is None or by == by_) and (col is None or col == col_)
+                    and all(c in df for c in columns) and fp == fingerprint(df, columns)):
+                del self._entries[key]
+
+    def clear(self):
+        self.invalidate()
+        self.hits = self.misses = self.evictions = 0
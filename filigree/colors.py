@@ -1,22 +1,147 @@
 import numpy as np
 import colorsys
+import warnings
+from functools import lru_cache
+
+# two hex digits of every byte value, to format many colors at once
+_HEX_BYTES = np.array([f'{i:02X}' for i in range(256)])
+
+
+def get_colors_array(n, rng=None):
+    """n evenly spaced hues with random lightness and saturation
+
+        return: np.array of shape (n, 3) of (hue, lightness, saturation) in [0, 1]
+    """
+    rng = np.random if rng is None else rng
+    hue = np.arange(0., 360., 360. / n)[:n] / 360
+    lightness = (50 + 10 * rng.random(n)) / 100
+    saturation = (90 + 10 * rng.random(n)) / 100
+
+    return np.stack([hue, lightness, saturation], axis=1)
+
+def _hue_to_rgb_array(m1, m2, hue):
+    hue = hue % 1.
+    return np.where(hue < 1/6, m1 + (m2 - m1) * hue * 6,
+                    np.where(hue < 1/2, m2,
+                             np.where(hue < 2/3, m1 + (m2 - m1) * (2/3 - hue) * 6, m1)))
+
+def hls_to_rgb_array(hls):
+    """Vectorized colorsys.hls_to_rgb of an array of shape (n, 3), return shape (n, 3)
+    """
+    hls = np.asarray(hls, dtype=float).reshape(-1, 3)
+    h, l, s = hls[:, 0], hls[:, 1], hls[:, 2]
+    m2 = np.where(l <= 0.5, l * (1 + s), l + s - l * s)
+    m1 = 2 * l - m2
+    rgb = np.stack([_hue_to_rgb_array(m1, m2, h + 1/3),
+                    _hue_to_rgb_array(m1, m2, h),
+                    _hue_to_rgb_array(m1, m2, h - 1/3)], axis=1)
+
+    return np.where((s == 0).reshape(-1, 1), l.reshape(-1, 1), rgb)
+
+def rgb_to_hex_array(rgb):
+    """Hex strings '#RRGGBB' of an array of rgb values in [0, 1] of shape (n, 3)
+    """
+    b = np.clip((np.asarray(rgb, dtype=float).reshape(-1, 3) * 255).astype(int), 0, 255)
+
+    return np.char.add(np.char.add(np.char.add('#', _HEX_BYTES[b[:, 0]]), _HEX_BYTES[b[:, 1]]),
+                       _HEX_BYTES[b[:, 2]])
 
 def get_colors(n):
-    hue = np.arange(0., 360., 360. / n) / 360
-    lightness = (50 + 10 * np.random.rand(n)) / 100
-    saturation = (90 + 10 * np.random.rand(n)) / 100
-    return list(zip(hue, lightness, saturation))
+    return list(map(tuple, get_colors_array(n)))
 
 def get_colors_rgb(n):
     return [colorsys.hls_to_rgb(*hls) for hls in get_colors(n)]
 
 def get_colors_hex(n):
-    return [rgb_to_hex(rgb) for rgb in get_colors_rgb(n)]
+    return rgb_to_hex_array(hls_to_rgb_array(get_colors_array(n))).tolist()
 
 
 def rgb_to_hex(rgb):
-    h = ['{:02X}'.format(int(v * 255)) for v in rgb]
-    return '#' + ''.join(h)
+    return str(rgb_to_hex_array(rgb)[0])
+
+def hex_to_rgb(color):
+    """np.array of the rgb values in [0, 1] of a hex string '#RRGGBB'"""
+    return np.array([int(color.lstrip('#')[k:k + 2], 16) for k in (0, 2, 4)]) / 255
+
+def random_rgb(n):
+    """rgb values in [0, 1] of get_colors_array(n), list of np.array"""
+    return list(hls_to_rgb_array(get_colors_array(n)))
+
+def mix_colors(*rgbs):
+    """Mean of rgb values"""
+    return np.mean(rgbs, axis=0)
+
+@lru_cache(maxsize=64)
+def _lut(palette, n):
+    palette = np.array(palette)
+    if n is None or n == len(palette):
+        return palette
+    # as bokeh.palettes.linear_palette, but allowing n > len(palette)
+    return palette[np.floor(np.linspace(0, len(palette) - 1, n)).astype(int)]
+
+@lru_cache(maxsize=64)
+def _lut_nan(palette, n, nan_color):
+    return np.append(_lut(palette, n), nan_color)
+
+def palette_lut(palette, n=None):
+    """Cached np.array of the colors of `palette`, resampled to n colors when n is given
+    """
+    return _lut(tuple(palette), n)
+
+def map_colors(values, n, vmin=None, vmax=None, norm='linear', clip=True):
+    """Palette index of every value in one numpy operation
+
+        Args:
+            values, array-like: numeric values
+            n, int: number of palette colors
+            vmin, vmax, numeric: values mapped to the first and last color, default the
+                     min and max of values (the smallest positive value for vmin with norm='log')
+            norm, str: 'linear', 'sqrt' or 'log' scaling between vmin and vmax
+            clip, bool: values outside [vmin, vmax] get the first/last color, otherwise -1
+                     (nan values always get -1)
+
+        return: np.array(int) of indices in [0, n - 1], floor of the scaled value times n - 1
+    """
+    values = np.asarray(values, dtype=float)
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if vmin is None:
+            vmin = np.nanmin(np.where(values > 0, values, np.nan) if norm == 'log' else values)
+        if vmax is None:
+            vmax = np.nanmax(values)
+    vmin = 1. if np.isnan(vmin) else vmin
+    vmax = vmin if np.isnan(vmax) else vmax
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if vmax == vmin:
+            t = np.where(values < vmin, -1., np.where(values > vmax, 2., 0.))
+        elif norm == 'linear':
+            t = (values - vmin) / (vmax - vmin)
+        elif norm == 'sqrt':
+            t = np.where(values < vmin, -1., np.sqrt((values - vmin) / (vmax - vmin)))
+        elif norm == 'log':
+            t = np.where(values < vmin, -1., np.log(values / vmin) / np.log(vmax / vmin))
+        else:
+            raise ValueError(f"norm must be 'linear', 'sqrt' or 'log', not {norm!r}")
+        idx = (np.clip(t, 0, 1) * (n - 1)).astype(int)
+
+    bad = np.isnan(values)
+    if not clip:
+        bad |= (t < 0) | (t > 1)
+    if bad.any():
+        idx[bad] = -1
+
+    return idx
+
+def colormap(values, palette, n=None, nan_color='#00000000', **kwargs):
+    """Hex color of every value from a cached palette lookup table (see map_colors for kwargs)
+
+        return: np.array(str)
+    """
+    lut = _lut_nan(tuple(palette), n, nan_color)
+
+    # index -1 picks nan_color
+    return lut[map_colors(values, len(lut) - 1, **kwargs)]
 
 def _hue_to_rgb(p, q, t):
     if t < 0:
@@ -30,19 +155,8 @@ def _hue_to_rgb(p, q, t):
         return q
     elif t < 2/3:
         return p + (q - p) * (2/3 - t) * 6
-    
+
     return p
 
 def hsl_to_rgb(h, s, l):
-    if s == 0:
-        r = l
-        g = l
-        b = l
-    else:
-        q = l * (1 + 2) if l < .5 else l + s - l * s
-        p = 2 * l - q
-        r = _hue_to_rgb(p, q, h + 1/3)
-        g = _hue_to_rgb(p, q, h)
-        b = _hue_to_rgb(p, q, h - 1/3)
-
-    return r, g, b
+    return tuple(hls_to_rgb_array([h, l, s])[0])
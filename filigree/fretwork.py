@@ -1,5 +1,8 @@
 import numpy as np
-from tools import calculate_quantiles, plural_multi_agg
+
+from filigree.colors import palette_lut, map_colors
+from filigree.tools import calculate_quantiles
+from filigree.profiling import profiled
 
 
 def qhist(data, centered=True, width=.8, transform=None):
@@ -37,6 +40,53 @@ def qhist(data, centered=True, width=.8, transform=None):
     return hxs, [_ / max(scls) * width for _ in hys]
 
 
+@profiled('geometry', groups=lambda r: r[0].shape[0])
+def qhists(data, centered=True, width=.8):
+    """qhist for every row of a tools.calculate_quantiles table at once
+
+        return:
+            tuple of np.arrays (xs, ys) of shape (n_rows, n_bins, 4), xs[i] and ys[i]
+                 equal the arrays returned by qhist(data.iloc[i])
+    """
+    assert width > 0
+    hx = np.array([0.0, 0.0, 1.0, 1.0])
+    hy = np.array([0.0, 1.0, 1.0, 0.0]) - (0.5 * centered)
+    qcols = sorted([_ for _ in data.keys() if _.startswith('q_0')])
+    qs = np.array([int(_[-4:]) / 1000 for _ in qcols])
+
+    Q = data[qcols].to_numpy(dtype=float)
+    p = np.diff(Q, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scls = np.diff(qs) / p
+        hys = hy * (scls / scls.max(axis=1, keepdims=True) * width)[:, :, None]
+
+    return hx * p[:, :, None] + Q[:, :-1, None], hys
+
+def nan_separated(a):
+    """Join the rows of a 2-D array into one 1-D array separated by NaN, as single
+        bokeh patch/line glyphs draw NaN separated parts
+    """
+    a = np.asarray(a)
+    out = np.full((a.shape[0], a.shape[1] + 1), np.nan, dtype=a.dtype)
+    out[:, :-1] = a
+
+    return out.ravel()[:-1]
+
+@profiled('geometry', groups=lambda r: r[0].shape[0])
+def draw_box_plots(boxes, centers, width=1):
+    """_draw_box_plot for every row of a calculate_boxes table at once
+
+        return: tuple (np.array(xcoordinates), np.array(ycoordinates)) both of shape (n_rows, 20)
+    """
+    q1, q2, q3 = boxes['q1'].to_numpy(), boxes['q2'].to_numpy(), boxes['q3'].to_numpy()
+    q0 = np.maximum(boxes['lower'].to_numpy(), boxes['qmin'].to_numpy())
+    q4 = np.minimum(boxes['upper'].to_numpy(), boxes['qmax'].to_numpy())
+    nan = np.full(len(boxes), np.nan)
+    y = np.stack([q1, q1, q3, q3, q1, nan, q2, q2, nan, q0, q1, nan, q3, q4, nan, q0, q0, nan, q4, q4], axis=1)
+    x = np.array([0, 1, 1, 0, 0, np.nan, 0, 1, np.nan, 0.5, 0.5, np.nan, 0.5, 0.5, np.nan, 0, 1, np.nan, 0, 1]) - 0.5
+
+    return x * width + np.asarray(centers, dtype=float).reshape(-1, 1), y
+
 def _draw_box_plot(center=0, width=1, qmin=-2, q1=-0.5, q2=0.0, q3=0.5, qmax=2, mu=0.0, n_records=1337, iqr=1.0, lower=-2, upper=2):
     """Draw a box plot with input measurements (draw using bokeh.figure.line or many in a list with multi_line)
 
@@ -63,26 +113,43 @@ def _draw_box_plot(center=0, width=1, qmin=-2, q1=-0.5, q2=0.0, q3=0.5, qmax=2,
     
     return x * width + center, y
 
-def calculate_boxes(df, by, col, outlier_r=1.5):
-    
-    return (plural_multi_agg(df.groupby(by),
-                                qmin=lambda x: x[col].min(),
-                                q1=lambda x: x[col].quantile(.25),
-                                q2=lambda x: x[col].quantile(.5),
-                                q3=lambda x: x[col].quantile(.75),
-                                qmax=lambda x: x[col].max(),
-                                mu=lambda x: x[col].mean(),
-                                n_records=lambda x: len(x))
-                .assign(iqr=lambda x: x.q3 - x.q1,
-                        lower=lambda x: x.q1 - x.iqr * outlier_r,
-                        upper=lambda x: x.q3 + x.iqr * outlier_r
-                       )
-             )
-
-def is_outlier(df, by, col, outlier_r=1.5, sf=None):
+@profiled('aggregation')
+def calculate_boxes(df, by, col, outlier_r=1.5, weights=None):
+    """Box plot statistics of `col` by groups of `by`, computed for all groups in one grouped pass
+
+        The statistics are those of the quartiles table of tools.calculate_quantiles (see
+        boxes_from_quantiles), so boxes derived from cached quantiles are identical: n_records
+        counts non-null values and groups without any are left out.
+
+        weights, str: default None, column of record weights (see tools.calculate_quantiles),
+                 n_records is then the total weight of non-null values
+
+        return: pandas.DataFrame indexed by group with columns
+                 qmin, q1, q2, q3, qmax, mu, n_records, iqr, lower, upper
+    """
+    return boxes_from_quantiles(calculate_quantiles(df, by, col, quantiles=(.25, .5, .75), weights=weights),
+                                outlier_r=outlier_r)
+
+def boxes_from_quantiles(qt, outlier_r=1.5):
+    """Box plot statistics (as calculate_boxes) from a tools.calculate_quantiles table
+        that includes the quartiles .25, .5 and .75
+    """
+    return (qt.rename(columns={'q_0250': 'q1', 'q_0500': 'q2', 'q_0750': 'q3'})
+              [['qmin', 'q1', 'q2', 'q3', 'qmax', 'mu', 'n_records']]
+              .assign(iqr=lambda x: x.q3 - x.q1,
+                      lower=lambda x: x.q1 - x.iqr * outlier_r,
+                      upper=lambda x: x.q3 + x.iqr * outlier_r
+                     )
+           )
+
+@profiled('outliers', groups=lambda r: r.iloc[:, 0].nunique())
+def is_outlier(df, by, col, outlier_r=1.5, sf=None, cache=None, weights=None):
+    """df[[by, col]] (and the weights column) with boolean columns is_low, is_high and is_outlier
+    """
     if sf is None:
-        sf = calculate_boxes(df, by, col, outlier_r=outlier_r)
-    return (df[[by, col]]
+        sf = (calculate_boxes(df, by, col, outlier_r=outlier_r, weights=weights) if cache is None
+              else cache.boxes(df, by, col, outlier_r=outlier_r, weights=weights))
+    return (df[[by, col] + ([] if weights is None else [weights])]
               .join(sf[['lower', 'upper']], on=by)
               .assign(is_low=lambda x: (x[col] < x.lower),
                       is_high=lambda x: (x.upper < x[col]),
@@ -91,10 +158,134 @@ def is_outlier(df, by, col, outlier_r=1.5, sf=None):
            )
     
 
-def create_square_patches(x, y, z, width=1, palette=Cividis256):
+@profiled('outliers', groups=lambda r: len(r[1]))
+def sample_outliers(codes, values, is_high, n_groups, max_outliers=None, keep_extremes=10, rng=None):
+    """Downsample outliers to a budget per group, keeping the most extreme ones
+
+        The `keep_extremes` lowest low outliers and highest high outliers of every group are
+        always kept (even beyond the budget), a uniform sample of the remaining outliers fills
+        the rest of the group's `max_outliers`.
+
+        Args:
+            codes, np.array(int): group of each outlier, 0 <= code < n_groups
+            values, np.array: value of each outlier
+            is_high, np.array(bool): outlier above the upper fence (else below the lower one)
+            max_outliers, int: default None keeps every outlier
+            rng: seed or np.random.Generator of the sample
+
+        return: tuple (kept, dropped), indices of the kept outliers in ascending order and
+                 the number of outliers dropped per group
+    """
+    n = np.bincount(codes, minlength=n_groups)
+    if max_outliers is None:
+        return np.arange(len(codes)), np.zeros(n_groups, dtype=np.int64)
+    rng = np.random.default_rng(rng)
+
+    side = is_high.astype(np.int64)
+    order = np.lexsort((np.where(is_high, -values, values), side, codes))
+    segment = codes[order] * 2 + side[order]
+    keep = np.zeros(len(codes), dtype=bool)
+    keep[order] = np.arange(len(order)) - np.searchsorted(segment, segment) < keep_extremes
+
+    budget = np.maximum(max_outliers - np.bincount(codes[keep], minlength=n_groups), 0)
+    rest = np.flatnonzero(~keep)
+    # a random priority per outlier sorted within groups draws a uniform sample without replacement
+    order = rest[np.lexsort((rng.random(len(rest)), codes[rest]))]
+    rank = np.arange(len(order)) - np.searchsorted(codes[order], codes[order])
+    keep[order[rank < budget[codes[order]]]] = True
+    kept = np.flatnonzero(keep)
+
+    return kept, n - np.bincount(codes[kept], minlength=n_groups)
+
+@profiled('geometry', groups=lambda r: len(r[0]))
+def merge_cells(codes):
+    """Merge neighbouring cells of a 2-D grid sharing a code into rectangles
+
+        Runs of equal codes are found along each row (run length encoding), then runs with
+        the same columns and code in consecutive rows are stacked into one rectangle.
+
+        Args:
+            codes, 2-D np.array(int): code (e.g. color index) of each cell, negative codes are left out
+
+        return:
+            tuple (i0, i1, j0, j1, code, labels) of np.arrays, rectangle k covers rows i0[k]:i1[k]
+                 and columns j0[k]:j1[k]; labels has the shape of codes and holds the rectangle
+                 of each cell (-1 for cells left out)
+    """
+    codes = np.asarray(codes)
+    nrows, ncols = codes.shape
+    flat = codes.ravel()
+    if not (flat >= 0).any():
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty, flat[:0], np.full((nrows, ncols), -1)
+
+    new_run = np.ones(flat.shape, dtype=bool)
+    new_run[1:] = flat[1:] != flat[:-1]
+    new_run[::ncols] = True
+    run_of_cell = np.cumsum(new_run) - 1
+    starts = np.flatnonzero(new_run)
+    ends = np.append(starts[1:], flat.size)
+    ri, rj0 = np.divmod(starts, ncols)
+    rj1 = rj0 + ends - starts
+    rcode = flat[starts]
+
+    kept = np.flatnonzero(rcode >= 0)
+    order = kept[np.lexsort((ri[kept], rcode[kept], rj1[kept], rj0[kept]))]
+    new_rect = np.ones(len(order), dtype=bool)
+    new_rect[1:] = ((rj0[order][1:] != rj0[order][:-1]) | (rj1[order][1:] != rj1[order][:-1])
+                    | (rcode[order][1:] != rcode[order][:-1]) | (ri[order][1:] != ri[order][:-1] + 1))
+    rect = np.cumsum(new_rect) - 1
+    first = np.flatnonzero(new_rect)
+    last = np.append(first[1:], len(order)) - 1
+
+    rect_of_run = np.full(len(starts), -1)
+    rect_of_run[order] = rect
+    labels = rect_of_run[run_of_cell].reshape(nrows, ncols)
+
+    return (ri[order][first], ri[order][last] + 1, rj0[order][first], rj1[order][first],
+            rcode[order][first], labels)
+
+def create_square_patches(x, y, z, width=1, palette=None, merge=False, norm='linear', vmin=None, vmax=None):
+    """Square patches of side `width` with lower left corners (x, y) colored by z
+
+        Args:
+            palette, list(str): default bokeh.palettes.Cividis256, indexed by z scaled from
+                     [0, max(z)] to [0, len(palette) - 1] (see colors.map_colors)
+            merge bool: default False, merge neighbouring squares on the lattice of spacing
+                     `width` with the same color into rectangles (see merge_cells)
+            norm, str: 'linear', 'sqrt' or 'log' scaling of z
+            vmin, vmax, numeric: default 0 (the smallest positive z for norm='log') and max(z),
+                     z mapped to the first and last color
+
+        return:
+            tuple (xs, ys, colors) with xs, ys of shape (n_patches, 4); when merge is True
+                 (xs, ys, colors, z, n_cells) with the mean z and the number of squares per patch
+    """
+    if palette is None:
+        from bokeh.palettes import Cividis256 as palette
     px = np.array([[0, 1, 1, 0]])
     py = np.array([[0, 0, 1, 1]])
     
-    cc = np.array(palette)[((z * len(palette) - 1) // max(z)).astype(int)]
+    lut = palette_lut(palette)
+    vmin = (0 if norm != 'log' else None) if vmin is None else vmin
+    ci = map_colors(z, len(lut), vmin=vmin, vmax=np.nanmax(z) if vmax is None else vmax, norm=norm)
+    cc = lut[ci]
     
-    return np.array(x).reshape(-1, 1) + px * width, np.array(y).reshape(-1, 1) + py * width, cc
+    if not merge:
+        return np.array(x).reshape(-1, 1) + px * width, np.array(y).reshape(-1, 1) + py * width, cc
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    z = np.asarray(z, dtype=float)
+    ix = np.rint((x - x.min()) / width).astype(np.int64)
+    iy = np.rint((y - y.min()) / width).astype(np.int64)
+    codes = np.full((ix.max() + 1, iy.max() + 1), -1)
+    codes[ix, iy] = ci
+    i0, i1, j0, j1, code, labels = merge_cells(codes)
+    cell = labels[ix, iy]
+    n_cells = np.bincount(cell, minlength=len(code))
+    x0, x1 = x.min() + i0 * width, x.min() + i1 * width
+    y0, y1 = y.min() + j0 * width, y.min() + j1 * width
+
+    return (np.stack([x0, x1, x1, x0], axis=1), np.stack([y0, y0, y1, y1], axis=1),
+            lut[code], np.bincount(cell, z, minlength=len(code)) / n_cells, n_cells)
@@ -1,62 +1,131 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from tools import frequency, calculate_quantiles
+import pandas as pd
 
-def box_plots(df, by, col, outlier_r=1.5, width=None, center_map=None, jitter=True):
-    
-    sf = calculate_boxes(df, by, col, outlier_r=outlier_r)
+from filigree.colors import palette_lut, map_colors
+from filigree.metrics import SliceStats
+from filigree.tools import calculate_quantiles, quantile_label, sort_segments, segment_summary, bin_features
+from filigree.fretwork import (qhists, draw_box_plots, nan_separated, calculate_boxes, boxes_from_quantiles,
+                               is_outlier, sample_outliers, merge_cells, create_square_patches)
+from filigree.profiling import profiled
+
+
+def _layout(a, layout, dtype=None):
+    """Coordinates of shape (n_glyphs, n_points) in the requested output layout, for 'nan' one
+        row holding all glyphs NaN separated
+    """
+    a = np.ascontiguousarray(a, dtype=dtype)
+    if layout == 'lists':
+        return list(a)
+    if layout == 'nan':
+        return [nan_separated(a)]
+
+    return a
+
+def box_plots(df, by, col, outlier_r=1.5, width=None, center_map=None, jitter=True, sf=None, cache=None,
+              layout='lists', dtype=None, weights=None, max_outliers=None, keep_extremes=10, seed=0):
+    """Create box plots by groups of a column from a pandas.DataFrame
+
+        Args:
+            sf, pandas.DataFrame: precomputed output of fretwork.calculate_boxes (or
+                     sketches.QuantileSketch.calculate_boxes); outliers are then the records
+                     of `df` outside its fences
+            cache, cache.SummaryCache: reuse box statistics computed by earlier plots of `df`
+            layout, str: 'lists' (default) x and y of boxes and means are lists of one array per group,
+                     'arrays' they are contiguous 2-D arrays of shape (n_groups, n_points) that a
+                     ColumnDataSource sends as single binary buffers, 'nan' boxes and means
+                     are one row sources ({'x': [xs], 'y': [ys]}) of NaN separated arrays to draw
+                     with one bokeh multi_line and the columns of every group are moved to
+                     'groups'. Other columns are arrays for 'arrays' and 'nan'.
+            dtype, numpy dtype: coordinates dtype (e.g. np.float32 for smaller payloads)
+            weights, str: default None, column of record weights (e.g. counts of pre-aggregated
+                     values); statistics and outlier counts and portions are those of the records
+                     repeated by their weights, outliers hold one point per record and their weight
+            max_outliers, int: default None, budget of outlier points per group, the `keep_extremes`
+                     most extreme points on each side are always kept and a uniform sample of
+                     the others fills the budget (see fretwork.sample_outliers); boxes 'dropped'
+                     counts the outliers left out of each group
+            seed, int or np.random.Generator: seed of the outlier jitter and sample, the output is
+                     reproducible for a fixed seed
+
+        Return:
+            dict with 'boxes' (x, y, group, nlo, nho, plo, pho, n, dropped), 'outliers' and 'means';
+                 nlo/nho count the low/high outliers of each group and plo/pho are their portions.
+                 For layout='nan' 'boxes' and 'means' hold x and y only and 'groups' the others
+    """
+    assert layout in ('lists', 'arrays', 'nan')
+    if sf is None:
+        sf = (calculate_boxes(df, by, col, outlier_r=outlier_r, weights=weights) if cache is None
+              else cache.boxes(df, by, col, outlier_r=outlier_r, weights=weights))
     
     width = 0.8 if width is None else width
     
     if center_map is None:
-        if 'int' not in df[by].dtype.name:
-            center_map = {g: i for i, g in enumerate(sorted(list(set(df[by]))))}
+        if 'int' not in sf.index.dtype.name:
+            center_map = {g: i for i, g in enumerate(sorted(sf.index))}
         else:
-            center_map = {g: g for g in set(df[by])}
-    
-    
-    
-    df_ = is_outlier(df, by, col, outlier_r=outlier_r, sf=sf)
-    
-    bxs = []
-    bys = []
-    nlo = []
-    nho = []
-    plo = []
-    pho = []
-    nrs = []
-    
-    lx = np.array([-.5, 0.5])
-    ly = np.array([0, 0])
-    mxs = []
-    mys = []
-    
-    groups = []
-    for g, dat in sf.iterrows():
-        _x, _y = _draw_box_plot(center=center_map[g], width=width, **dat.to_dict())
-        bxs.append(_x)
-        bys.append(_y)
-        mxs.append(lx * width + center_map[g])
-        mys.append(ly + dat['mu'])
-        nlo.append(df_.is_low.sum())
-        nho.append(df_.is_high.sum())
-        plo.append(df_.is_low.mean())
-        pho.append(df_.is_high.mean())
-        nrs.append(dat['n_records'])
-        groups.append(g)
-    
-    oxs = df_.loc[df_.is_outlier, by].apply(lambda g: center_map[g]).values + width * (np.random.uniform(size=df_.is_outlier.sum()) * 0.8 - 0.4)
-    ogs = df_.loc[df_.is_outlier, by].values
-    oys = df_.loc[df_.is_outlier, col].values
+            center_map = {g: g for g in sf.index}
 
-    center_map = {v: k for k, v in center_map.items()}
-    
-    return {'boxes': {'x': bxs, 'y': bys, 'group': groups,
-                      'nlo': nlo, 'nho': nho, 'plo': plo, 'pho': pho, 'n': nrs},
-            'outliers': {'x': oxs, 'y': oys, 'group': ogs},
-            'means': {'x': mxs, 'y': mys, 'group': groups}}
+    return _box_plot_data(sf, is_outlier(df, by, col, outlier_r=outlier_r, sf=sf, weights=weights), by, col,
+                          width=width, center_map=center_map, layout=layout, dtype=dtype, weights=weights,
+                          jitter=jitter, max_outliers=max_outliers, keep_extremes=keep_extremes, seed=seed)
+
+def _box_plot_data(sf, df_, by, col, center_map, width=.8, layout='lists', dtype=None, weights=None,
+                   jitter=True, max_outliers=None, keep_extremes=10, seed=0):
+    """box_plots output from box statistics and the output of fretwork.is_outlier
+    """
+    groups = sf.index.to_numpy()
+    centers = np.array([center_map[g] for g in groups], dtype=float)
+    bxs, bys = draw_box_plots(sf, centers, width=width)
+    mxs = np.array([-.5, 0.5]) * width + centers.reshape(-1, 1)
+    mys = np.repeat(sf['mu'].to_numpy().reshape(-1, 1), 2, axis=1)
+
+    # outlier counts and portions of every group in one grouped pass over the group codes
+    codes = sf.index.get_indexer(df_[by])
+    w = np.ones(len(df_)) if weights is None else df_[weights].fillna(0).to_numpy(dtype=float)
+    is_low, is_high = df_['is_low'].to_numpy(dtype=bool), df_['is_high'].to_numpy(dtype=bool)
+    valid = codes >= 0
+    c, wv = codes[valid], w[valid]
+    n_rows = np.bincount(c, wv, minlength=len(groups))
+    nlo = np.bincount(c, wv * is_low[valid], minlength=len(groups))
+    nho = np.bincount(c, wv * is_high[valid], minlength=len(groups))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        plo, pho = nlo / n_rows, nho / n_rows
+    if weights is None:
+        nlo, nho = nlo.astype(np.int64), nho.astype(np.int64)
+
+    # one generator for the sample and the jitter, two seeded alike would draw the same stream
+    rng = np.random.default_rng(seed)
+    # records of zero weight are not drawn
+    rows = np.flatnonzero((is_low | is_high) & valid & (w > 0))
+    values = df_[col].to_numpy()
+    kept, dropped = sample_outliers(codes[rows], values[rows].astype(float), is_high[rows], len(groups),
+                                    max_outliers=max_outliers, keep_extremes=keep_extremes, rng=rng)
+    rows = rows[kept]
+    oxs = centers[codes[rows]]
+    if jitter:
+        oxs = oxs + width * rng.uniform(-.4, .4, size=len(rows))
+    outliers = {'x': oxs, 'y': values[rows], 'group': df_[by].to_numpy()[rows]}
+    if weights is not None:
+        outliers['weight'] = df_[weights].to_numpy()[rows]
+
+    nrs = sf['n_records'].to_numpy()
+    if layout == 'lists':
+        groups, nlo, nho, plo, pho, nrs, dropped = [_.tolist() for _ in (groups, nlo, nho, plo, pho, nrs, dropped)]
+
+    stats = {'group': groups, 'nlo': nlo, 'nho': nho, 'plo': plo, 'pho': pho, 'n': nrs, 'dropped': dropped}
+    boxes = {'x': _layout(bxs, layout, dtype), 'y': _layout(bys, layout, dtype)}
+    means = {'x': _layout(mxs, layout, dtype), 'y': _layout(mys, layout, dtype)}
+    if layout == 'nan':
+        # one row sources can not hold a column per group
+        return {'boxes': boxes, 'outliers': outliers, 'means': means, 'groups': stats}
+
+    return {'boxes': {**boxes, **stats}, 'outliers': outliers, 'means': {**means, 'group': groups}}
 
 def qhistograms(df, by, col, quantiles=np.arange(0.25, .8, .05), centered=True, 
-                absolute=False, center_map=None, width=.8, transform=None):
+                absolute=False, center_map=None, width=.8, transform=None, qt=None, cache=None,
+                layout='lists', dtype=None, weights=None):
     """Create multiple quantile histograms by groups of a column from a pandas.DataFrame
 
         Args:
@@ -72,64 +141,237 @@ def qhistograms(df, by, col, quantiles=np.arange(0.25, .8, .05), centered=True,
             width, numeric: how wide to scale histogram
             transform: method to scale height (sqrt to see detail of distribution 
                      tails when plotting small multiples)
+            qt, pandas.DataFrame: precomputed output of tools.calculate_quantiles (or
+                     sketches.QuantileSketch.calculate_quantiles) for `quantiles`, `df` is unused
+            cache, cache.SummaryCache: reuse quantiles computed by earlier plots of `df`
+            layout, str: 'lists' (default) x and y are lists of one array per bin, 'arrays' they
+                     are contiguous 2-D arrays of shape (n_bins, 4) that a ColumnDataSource sends as
+                     single binary buffers, 'nan' histograms and medians are one row sources
+                     ({'x': [xs], 'y': [ys]}) of NaN separated arrays to draw with one bokeh patches
+                     or multi_line and the columns of every bin are moved to 'bins'. Other columns
+                     are arrays for 'arrays' and 'nan'.
+            dtype, numpy dtype: coordinates dtype (e.g. np.float32 for smaller payloads)
+            weights, str: default None, column of record weights (e.g. counts of pre-aggregated
+                     values), quantiles and counts are those of the records repeated by their weights
 
         Return:
-            dict with structure to plot histograms using ColumnDataSource
+            dict with structure to plot histograms using ColumnDataSource, 'histograms' (x, y,
+                 lower, upper, g, n, name) and 'medians' (x, y); for layout='nan' 'histograms'
+                 holds x and y only and 'bins' the others
     """
     assert len(quantiles) > 2
+    assert layout in ('lists', 'arrays', 'nan')
     quantiles = np.sort(quantiles)
     
-    qt = calculate_quantiles(df, by, col, quantiles=quantiles)
+    if qt is None:
+        qt = (calculate_quantiles(df, by, col, quantiles=quantiles, weights=weights) if cache is None
+              else cache.quantiles(df, by, col, quantiles=quantiles, weights=weights))
     tot_records = qt.n_records.sum()
     
     qcols = sorted([_ for _ in qt.columns if _.startswith('q_0')])
     
     
     if center_map is None:
-        if 'int' not in df[by].dtype.name:
-            center_map = {g: i for i, g in enumerate(sorted(list(set(df[by]))))}
+        if 'int' not in qt.index.dtype.name:
+            center_map = {g: i for i, g in enumerate(sorted(qt.index))}
         else:
-            center_map = {g: g for g in set(df[by])}
+            center_map = {g: g for g in qt.index}
     
     mx = (np.array([0, 1]) - (0.5 * centered)) * width
     my = np.array([0, 0])
     
-    hxs = []
-    hys = []
-    nrs = []
-    lows = []
-    upps = []
-    group = []
-    names = []
-    mxs = []
-    mys = []
-    qp = []
-    
-    for g, dat in qt.iterrows():
-        # rotates hx  & hy to make verticle graphs
-        hy, hx = qhist(dat, centered=centered)
-        hxs += [_ + center_map[g] for _ in hx]
-        hys += hy
-        lows += [min(_) for _ in hy]
-        upps += [max(_) for _ in hy]
-        group += [g] * len(hy)
-        names += [f"{l * 100:4.1f}-{u * 100:4.1f}" for l, u in zip(quantiles[:-1], quantiles[1:])]
-        nrs += ((quantiles[1:] - quantiles[:-1]) * dat['n_records']).astype(int).tolist()
-        
-        mxs.append(mx + center_map[g])
-        mys.append(my + dat['qmedian'])
+    groups = qt.index.to_numpy()
+    centers = np.array([center_map[g] for g in groups], dtype=float)
+    # rotates hx  & hy to make verticle graphs
+    hy, hx = qhists(qt, centered=centered)
+    nbins = hx.shape[1]
+    hxs = (hx + centers.reshape(-1, 1, 1)).reshape(-1, 4)
+    hys = hy.reshape(-1, 4)
+    lows = hy.min(axis=2).ravel()
+    upps = hy.max(axis=2).ravel()
+    group = np.repeat(groups, nbins)
+    names = np.tile([f"{l * 100:4.1f}-{u * 100:4.1f}" for l, u in zip(quantiles[:-1], quantiles[1:])], len(groups))
+    nrs = ((quantiles[1:] - quantiles[:-1]) * qt['n_records'].to_numpy().reshape(-1, 1)).astype(int).ravel()
+    mxs = mx + centers.reshape(-1, 1)
+    mys = my + qt['qmedian'].to_numpy().reshape(-1, 1)
+    if layout == 'lists':
+        lows, upps, group, names, nrs = [_.tolist() for _ in (lows, upps, group, names, nrs)]
         
-    return {'histograms': {'x': hxs,
-                           'y': hys,
-                           'lower': lows,
-                           'upper': upps,
-                           'g': group,
-                           'n': nrs,
-                           'name': names
-                          },
-            'medians': {'x': mxs,
-                        'y': mys}
+    bins = {'lower': lows,
+            'upper': upps,
+            'g': group,
+            'n': nrs,
+            'name': names
            }
+    histograms = {'x': _layout(hxs, layout, dtype), 'y': _layout(hys, layout, dtype)}
+    medians = {'x': _layout(mxs, layout, dtype), 'y': _layout(mys, layout, dtype)}
+    if layout == 'nan':
+        # one row sources can not hold a column per bin
+        return {'histograms': histograms, 'medians': medians, 'bins': bins}
+
+    return {'histograms': {**histograms, **bins}, 'medians': medians}
+
+def _batch_column(df, by, col, codes, groups, center_map, kinds, quantiles, outlier_r,
+                  qhist_kwargs, box_kwargs, weights):
+    values = df[col].to_numpy(dtype=float)
+    keep = (codes >= 0) & ~np.isnan(values)
+    labels = {quantile_label(q): q for q in quantiles}
+    summary_qs = list({**labels, **{quantile_label(q): q for q in (.25, .5, .75)}}.values())
+    if weights is None:
+        sorted_values, offsets = sort_segments(codes[keep], values[keep], len(groups))
+        w = None
+    else:
+        w = df[weights].fillna(0).to_numpy(dtype=float)
+        keep &= w > 0
+        sorted_values, offsets, w = sort_segments(codes[keep], values[keep], len(groups), weights=w[keep])
+    qt = pd.DataFrame(segment_summary(sorted_values, offsets, quantiles=summary_qs, weights=w),
+                      index=pd.Index(groups, name=by))
+
+    out = {}
+    if 'qhistograms' in kinds:
+        columns = ['qmin', 'qmax', 'qmedian', 'mu', 'n_records'] + list(labels)
+        out['qhistograms'] = qhistograms(None, by, col, quantiles=quantiles, qt=qt.loc[qt.n_records > 0, columns],
+                                         center_map=center_map, **qhist_kwargs)
+    if 'box_plots' in kinds:
+        sf = boxes_from_quantiles(qt, outlier_r=outlier_r)
+        # fences gathered by group code instead of joining the frame on `by`
+        lower = np.append(sf['lower'].to_numpy(), np.nan)[codes]
+        upper = np.append(sf['upper'].to_numpy(), np.nan)[codes]
+        is_low, is_high = values < lower, upper < values
+        df_ = pd.DataFrame({by: df[by].to_numpy(), col: values, 'is_low': is_low, 'is_high': is_high,
+                            'is_outlier': is_low | is_high})
+        if weights is not None:
+            df_[weights] = df[weights].to_numpy()
+        out['box_plots'] = _box_plot_data(sf[sf.n_records > 0], df_, by, col, center_map=center_map,
+                                          weights=weights, **box_kwargs)
+
+    return out
+
+@profiled('aggregation')
+def batch_plots(df, by, cols, kinds=('box_plots', 'qhistograms'), quantiles=np.arange(0.25, .8, .05),
+                outlier_r=1.5, n_workers=None, qhist_kwargs=None, box_kwargs=None, weights=None):
+    """box_plots and qhistograms of many columns (small multiples) against one or more group keys
+
+        Each key in `by` is factorized once and shared by every column, each column is sorted
+        within groups once for all of its statistics, and columns are processed in a thread
+        pool (NumPy sorts and reductions release the GIL). Every plot of a key places the groups
+        of that key at the same centers, including groups a column has no values for.
+
+        Args:
+            by, str or list(str): group keys
+            cols, list(str): value columns
+            kinds, tuple(str): plots to build, 'box_plots' and/or 'qhistograms'
+            n_workers, int: default min(32, os.cpu_count() + 4) threads, 1 runs serially
+            qhist_kwargs, dict: other arguments of qhistograms (centered, absolute, width,
+                     transform, layout, dtype)
+            box_kwargs, dict: other arguments of box_plots (width, layout, dtype, jitter,
+                     max_outliers, keep_extremes, seed)
+            weights, str: default None, column of record weights shared by every column
+
+        return:
+            dict {col: {kind: plot data}} for a single `by`, {(by, col): {kind: plot data}} for a list
+                 (box_plots n counts non-null values)
+    """
+    assert set(kinds) <= {'box_plots', 'qhistograms'}
+    keys = [by] if isinstance(by, str) else list(by)
+    quantiles = np.sort(quantiles)
+
+    tasks = []
+    for key in keys:
+        codes, groups = pd.factorize(df[key], sort=True)
+        if 'int' not in groups.dtype.name:
+            center_map = {g: i for i, g in enumerate(groups)}
+        else:
+            center_map = {g: g for g in groups}
+        tasks += [(key, col, codes, groups, center_map) for col in cols]
+
+    def run(task):
+        key, col, codes, groups, center_map = task
+        return _batch_column(df, key, col, codes, groups, center_map, kinds, quantiles, outlier_r,
+                             qhist_kwargs or {}, box_kwargs or {}, weights)
+
+    if n_workers == 1:
+        results = list(map(run, tasks))
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(run, tasks))
+
+    return {(col if isinstance(by, str) else (key, col)): r for (key, col, *_), r in zip(tasks, results)}
+
+def batch_box_plots(df, by, cols, outlier_r=1.5, n_workers=None, weights=None, **kwargs):
+    """box_plots of many columns, see batch_plots
+
+        return: dict {col: box_plots output} ({(by, col): ...} for a list of keys)
+    """
+    return {k: v['box_plots'] for k, v in batch_plots(df, by, cols, kinds=('box_plots', ), outlier_r=outlier_r,
+                                                      n_workers=n_workers, box_kwargs=kwargs,
+                                                      weights=weights).items()}
+
+def batch_qhistograms(df, by, cols, quantiles=np.arange(0.25, .8, .05), n_workers=None, weights=None, **kwargs):
+    """qhistograms of many columns, see batch_plots
+
+        return: dict {col: qhistograms output} ({(by, col): ...} for a list of keys)
+    """
+    return {k: v['qhistograms'] for k, v in batch_plots(df, by, cols, kinds=('qhistograms', ), quantiles=quantiles,
+                                                        n_workers=n_workers, qhist_kwargs=kwargs,
+                                                        weights=weights).items()}
+
+@profiled('aggregation', groups=lambda r: len(r['heatmap']['value']))
+def slice_heatmap(df, features, y, yhat, metric='r2', bins=10, min_count=1, threshold=None, palette=None,
+                  norm='linear', vmin=None, vmax=None, gap=1, layout='lists', dtype=None):
+    """Heatmaps of a model performance metric f(y, yhat) in the slices (bin of feature i, bin of
+        feature j) of every pair of features, drawn as one lattice of square patches
+
+        Features are binned once (tools.bin_features), the sufficient statistics of every cell of
+        every pair are counted at once (metrics.SliceStats) and the metric derived from them.
+        Pair (i, j), i < j, is the block of n_bins x n_bins squares at x = i * (n_bins + gap),
+        y = (j - 1) * (n_bins + gap), bins of feature i along x.
+
+        Args:
+            y, yhat, str: columns of targets and predictions
+            metric, str or function: see metrics.SliceStats.metric
+            bins, int: bins per numeric feature
+            min_count, int: cells with fewer records are left out
+            threshold, numeric: see metrics.SliceStats
+            palette, norm, vmin, vmax: colors, see fretwork.create_square_patches (vmin defaults
+                     to the smallest value, as metrics like r2 can be negative)
+            layout, str: 'lists' or 'arrays' for the patch coordinates, see box_plots
+
+        return:
+            dict with 'heatmap' (x, y, color, value, n, xfeature, yfeature, xbin, ybin) to plot
+                 with bokeh.figure.patches, 'xticks' and 'yticks' {center of its blocks: feature}
+    """
+    assert layout in ('lists', 'arrays')
+    codes, labels = bin_features(df, features, bins=bins)
+    st = SliceStats(codes, df[y], df[yhat], threshold=threshold, statistics=SliceStats.requires.get(metric))
+    values = st.metric(metric)
+    B = st.n_bins
+    p, bi, bj = np.nonzero((st.n >= min_count) & ~np.isnan(values))
+    fi, fj = st.pairs[p, 0], st.pairs[p, 1]
+    z = values[p, bi, bj]
+
+    x = fi * (B + gap) + bi
+    y_ = (fj - 1) * (B + gap) + bj
+    if len(z):
+        vmin = np.nanmin(z) if vmin is None else vmin
+        xs, ys, colors = create_square_patches(x, y_, z, palette=palette, norm=norm, vmin=vmin, vmax=vmax)
+    else:
+        # no cell with min_count records and a defined metric, e.g. f1 without positives
+        xs, ys, colors = np.zeros((0, 4)), np.zeros((0, 4)), np.zeros(0, dtype=object)
+
+    features = list(features)
+    blabels = [np.array(l + [''] * (B - len(l)), dtype=object) for l in labels]
+    out = {'x': _layout(xs, layout, dtype), 'y': _layout(ys, layout, dtype), 'color': colors, 'value': z,
+           'n': st.n[p, bi, bj], 'xfeature': np.array(features, dtype=object)[fi],
+           'yfeature': np.array(features, dtype=object)[fj],
+           'xbin': np.array([blabels[f][b] for f, b in zip(fi, bi)], dtype=object),
+           'ybin': np.array([blabels[f][b] for f, b in zip(fj, bj)], dtype=object)}
+    if layout == 'lists':
+        out.update({k: out[k].tolist() for k in ('color', 'value', 'n', 'xfeature', 'yfeature', 'xbin', 'ybin')})
+    xticks = {k * (B + gap) + B / 2: f for k, f in enumerate(features[:-1])}
+    yticks = {k * (B + gap) + B / 2: f for k, f in enumerate(features[1:])}
+
+    return {'heatmap': out, 'xticks': xticks, 'yticks': yticks}
 
 def histogram(s, bins=None):
     """output (freq, bins, cts, width)
@@ -146,65 +388,131 @@ def histogram(s, bins=None):
            }
 
 
-def histogram2d(x, y, bins, group_largest=False, colors=Cividis256):
+def bin_codes(s, bins=100, bounds=None):
+    """Bin of every value on `bins` equal width bins
+
+        Args:
+            bounds, tuple: (min, max) of the bins, default those of the values
+
+        return: tuple (codes np.array(int), -1 for nan values, edges np.array of bins + 1 values)
+    """
+    v = np.asarray(s, dtype=float)
+    lo, hi = (np.nanmin(v), np.nanmax(v)) if bounds is None else bounds
+    hi = hi if hi > lo else lo + 1
+    edges = np.linspace(lo, hi, bins + 1)
+    with np.errstate(invalid='ignore'):
+        codes = np.clip(((v - lo) * (bins / (hi - lo))).astype(np.int64), 0, bins - 1)
+    codes[np.isnan(v) | (v < lo) | (v > hi)] = -1
+
+    return codes, edges
+
+@profiled('aggregation', groups=lambda r: len(r['counts']))
+def pair_histograms(df, pairs, bins=100):
+    """2d histograms of many pairs of columns from one binning of every column
+
+        Every column is binned once (see bin_codes), the histogram of a pair is one np.bincount
+        on the combined codes of its columns.
+
+        Args:
+            pairs, iterable: tuples (xcol, ycol)
+
+        return:
+            dict with 'edges' {col: bin edges} and 'counts' {(xcol, ycol): np.array of shape
+                 (bins, bins) indexed [x bin, y bin]}, rows with a nan in either column are left out
+    """
+    pairs = [tuple(p) for p in pairs]
+    edges = {}
+    codes = {}
+    for col in dict.fromkeys(c for p in pairs for c in p):
+        codes[col], edges[col] = bin_codes(df[col], bins=bins)
+
+    counts = {}
+    for xcol, ycol in pairs:
+        cx, cy = codes[xcol], codes[ycol]
+        valid = (cx >= 0) & (cy >= 0)
+        counts[xcol, ycol] = np.bincount(cx[valid] * bins + cy[valid], minlength=bins * bins).reshape(bins, bins)
+
+    return {'edges': edges, 'counts': counts}
+
+@profiled('geometry', groups=lambda r: len(r['histogram2d']['color']))
+def histogram2d(x, y, bins, group_largest=False, colors=None, drop_empty=False, merge=False, norm='linear'):
     """Create plot data structure of 2d histogram
 
         Args:
-            x,
-            y,
-            bins, tuple(iterable),
-            group_largest bool,
+            x, array-like: values along the x axis
+            y, array-like: values along the y axis
+            bins, int or tuple(iterable): passed to numpy.histogram2d
+            group_largest bool: draw the most common color as one background patch
+                     instead of a patch per cell
+            colors, list(str): palette indexed by cell count scaled to len(colors) - 1,
+                     default bokeh.palettes.Cividis256
+            drop_empty bool: skip cells with zero count
+            merge bool: merge neighbouring cells of the same color into rectangles (see
+                     fretwork.merge_cells), frequency, density and alpha of a merged patch are
+                     the mean of its cells and the added key 'cells' counts them
+            norm, str: 'linear', 'sqrt' or 'log' scaling of counts to colors (see colors.map_colors)
 
+        return:
+            dict with structure to plot with bokeh.figure.patches; 'x' and 'y' are arrays of shape
+                 (n_patches, 4) of rectangle corners, other keys are arrays of length n_patches
     """
-    H, xedges, yedges = np.histogram2d(df.hour_of_day, df.residuals, bins=bins)
-    
+    if colors is None:
+        from bokeh.palettes import Cividis256 as colors
+    H, xedges, yedges = np.histogram2d(x, y, bins=bins)
     
-    Hn = H / H.max()
-    Hp = H / len(df)
-    Hci = (Hn * 255).astype(int)
+    Hn = H / H.max() if H.max() > 0 else H
+    Hp = H / max(len(x), 1)
+    colors = palette_lut(colors)
+    Hci = map_colors(H, len(colors), vmin=0 if norm != 'log' else None, vmax=H.max(), norm=norm)
     
-    freq = frequency(Hci.ravel())
-    mode = max(freq, key=lambda s: freq[s])
-    mode_p = freq[mode] / Hci.size
-    xw = xedges[1] - xedges[0]
-    yw = yedges[1] - yedges[0]
-    patx = np.array([0, 1, 1, 0]) * xw
-    paty = np.array([0, 0, 1, 1]) * yw
+    mode = np.bincount(Hci.ravel(), minlength=len(colors)).argmax()
     
+    keep = np.ones(H.shape, dtype=bool)
     if group_largest:
-
-        xs = [np.array([0, 1, 1, 0]) * (xedges[-1] - xedges[0]) + xedges[0]]
-        ys = [np.array([0, 0, 1, 1]) * (yedges[-1] - yedges[0]) + yedges[0]]
-        cs = [colors[mode]]
-        ns = [mode]
-        ps = [mode / len(df)]
-        alps = [mode / H.max()]
+        keep &= Hci != mode
+    if drop_empty:
+        keep &= H > 0
+    if merge:
+        i0, i1, j0, j1, code, labels = merge_cells(np.where(keep, Hci, -1))
+        cell = labels[keep]
+        cells = np.bincount(cell, minlength=len(code))
+        cs = colors[code]
+        ns = np.bincount(cell, H[keep], minlength=len(code)) / cells
+        ps = np.bincount(cell, Hp[keep], minlength=len(code)) / cells
+        alps = np.bincount(cell, Hn[keep], minlength=len(code)) / cells
     else:
+        i0, j0 = np.nonzero(keep)
+        i1, j1 = i0 + 1, j0 + 1
+        cs = colors[Hci[i0, j0]]
+        ns = H[i0, j0]
+        ps = Hp[i0, j0]
+        alps = Hn[i0, j0]
 
-        xs = []
-        ys = []
-        cs = []
-        ns = []
-        ps = []
-        alps = []
-        
-    for i in range(Hci.shape[0]):
-        for j in range(Hci.shape[1]):
-            if group_largest and Hci[i, j] == mode:
-                continue
-            xs.append(patx + xedges[i])
-            ys.append(paty + yedges[j])
-            cs.append(colors[Hci[i, j]])
-            ns.append(H[i, j])
-            ps.append(Hp[i, j])
-            alps.append(Hn[i, j])
+    x0, x1 = xedges[i0], xedges[i1]
+    y0, y1 = yedges[j0], yedges[j1]
+    xs = np.stack([x0, x1, x1, x0], axis=1)
+    ys = np.stack([y0, y0, y1, y1], axis=1)
+
+    if group_largest:
+        # one background patch for every cell of the most common color, reported as the mean cell
+        msk = Hci == mode
+        xs = np.vstack([[[xedges[0], xedges[-1], xedges[-1], xedges[0]]], xs])
+        ys = np.vstack([[[yedges[0], yedges[0], yedges[-1], yedges[-1]]], ys])
+        cs = np.concatenate([[colors[mode]], cs])
+        ns = np.concatenate([[H[msk].mean()], ns])
+        ps = np.concatenate([[Hp[msk].mean()], ps])
+        alps = np.concatenate([[Hn[msk].mean()], alps])
+        if merge:
+            cells = np.concatenate([[msk.sum()], cells])
             
-    return {'histogram2d': {'x': xs,
-                            'y': ys,
-                            'color': cs,
-                            'frequency': ns,
-                            'density': ps,
-                            'alpha': alps
-                           }
-           }
+    out = {'x': xs,
+           'y': ys,
+           'color': cs,
+           'frequency': ns,
+           'density': ps,
+           'alpha': alps
+          }
+    if merge:
+        out['cells'] = cells
 
+    return {'histogram2d': out}
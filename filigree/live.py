@@ -0,0 +1,216 @@
+import numpy as np
+import pandas as pd
+
+from filigree.fretwork import boxes_from_quantiles
+from filigree.lattice import qhistograms, _box_plot_data
+from filigree.tools import sort_segments, segment_summary
+
+
+def apply_updates(sources, updates):
+    """Send the output of LiveBoxPlots.update or LiveQHistograms.update to the bokeh
+        ColumnDataSources created from their .data, e.g. in a periodic document callback
+
+        Args:
+            sources, dict: ColumnDataSource by name ('boxes', 'outliers', 'means' or
+                     'histograms', 'medians')
+    """
+    for name, update in updates.items():
+        if update['patch']:
+            sources[name].patch(update['patch'])
+        if update['stream']:
+            sources[name].stream(update['stream'])
+
+
+class _LivePlot(object):
+    """Sorted values of every group and the plot data built from them, rebuilt for the groups
+        touched by appended rows only
+
+        Every group owns a fixed block of `_rows[name]` rows of each source in order of first
+        appearance, so a touched group's rows are patched in place and a new group's rows are
+        streamed at the end.
+    """
+    _rows = {}
+
+    def __init__(self, by, col, center_map=None):
+        self.by = by
+        self.col = col
+        self.groups = []
+        self.center_map = {} if center_map is None else dict(center_map)
+        self._row = {}
+        self._values = []
+        self._data = None
+
+    @property
+    def data(self):
+        """Current plot data (dict of source name to dict of columns) to create the ColumnDataSources,
+            a copy as ColumnDataSource.stream extends the lists it was created from
+        """
+        return {name: {column: list(values) for column, values in columns.items()}
+                for name, columns in self._data.items()}
+
+    def _add(self, df):
+        """Merge the rows of df into the sorted values of their groups
+
+            return: np.array of the rows (order of first appearance) of the touched groups
+        """
+        values = df[self.col].to_numpy(dtype=float)
+        keys = df[self.by]
+        keep = (keys.notna() & ~np.isnan(values)).to_numpy()
+        codes, labels = pd.factorize(keys[keep])
+        sorted_values, offsets = sort_segments(codes, values[keep], len(labels))
+
+        touched = []
+        for i, g in enumerate(labels):
+            new = sorted_values[offsets[i]:offsets[i + 1]]
+            if g in self._row:
+                r = self._row[g]
+                old = self._values[r]
+                self._values[r] = np.insert(old, np.searchsorted(old, new), new)
+            else:
+                r = self._row[g] = len(self.groups)
+                self.groups.append(g)
+                self._values.append(new)
+                if g not in self.center_map:
+                    self.center_map[g] = g if isinstance(g, (int, np.integer)) else r
+            touched.append(r)
+
+        return np.sort(np.array(touched, dtype=np.int64))
+
+    def _summary(self, rows, quantiles):
+        """tools.calculate_quantiles table of the groups in rows, and their sorted values"""
+        counts = np.array([len(self._values[r]) for r in rows], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        values = np.concatenate([self._values[r] for r in rows]) if len(rows) else np.zeros(0)
+        groups = pd.Index([self.groups[r] for r in rows], name=self.by)
+
+        return pd.DataFrame(segment_summary(values, offsets, quantiles=quantiles), index=groups), values, counts
+
+    def _diff(self, rows, n_old, built):
+        """Store the rebuilt rows of the touched groups and return the patch/stream dicts
+
+            Args:
+                rows, np.array: sorted rows of the touched groups
+                n_old, int: number of groups before the update, rows >= n_old are new
+                built, dict: source name to columns holding `_rows[name]` entries per touched group
+        """
+        updates = {}
+        for name, columns in built.items():
+            k = self._rows[name]
+            old = rows[rows < n_old]
+            stream = {}
+            patch = {}
+            for column, values in columns.items():
+                values = list(values)
+                stored = self._data[name][column]
+                entries = []
+                for i, r in enumerate(old):
+                    block = values[i * k:(i + 1) * k]
+                    stored[r * k:(r + 1) * k] = block
+                    entries.append((int(r), block[0]) if k == 1 else (slice(int(r * k), int((r + 1) * k)), block))
+                if entries:
+                    patch[column] = entries
+                new = values[len(old) * k:]
+                if new:
+                    stored.extend(new)
+                    stream[column] = new
+            updates[name] = {'patch': patch, 'stream': stream}
+
+        return updates
+
+    def _build(self, rows):
+        raise NotImplementedError
+
+    def update(self, df):
+        """Add appended rows and rebuild the summaries and geometry of the groups they touch
+
+            return: dict of source name to {'patch': ..., 'stream': ...}, arguments of
+                     ColumnDataSource.patch and .stream holding only the changed rows (see apply_updates)
+        """
+        n_old = len(self.groups)
+        rows = self._add(df)
+        if self._data is None:
+            built = self._build(rows)
+            self._data = {name: {column: list(values) for column, values in columns.items()}
+                          for name, columns in built.items()}
+            return {name: {'patch': {}, 'stream': columns} for name, columns in self._data.items()}
+        if not len(rows):
+            return {name: {'patch': {}, 'stream': {}} for name in self._data}
+
+        return self._diff(rows, n_old, self._build(rows))
+
+
+class LiveBoxPlots(_LivePlot):
+    """lattice.box_plots of a growing DataFrame, updated with stream/patch diffs of the touched groups
+
+        Outliers are downsampled to at most max(max_outliers, 2 * keep_extremes) points per group
+        (see fretwork.sample_outliers), each group owns that many rows of the outliers source
+        padded with nan. Statistics count non-null values. Groups are centered as in box_plots
+        for integer labels, other labels are placed in order of first appearance.
+
+        Example:
+            live = LiveBoxPlots(df, 'hour', 'residual')
+            sources = {name: ColumnDataSource(data) for name, data in live.data.items()}
+            ...
+            apply_updates(sources, live.update(new_rows))
+    """
+    def __init__(self, df, by, col, outlier_r=1.5, width=.8, center_map=None, jitter=True,
+                 max_outliers=100, keep_extremes=10, seed=0):
+        assert max_outliers is not None
+        super().__init__(by, col, center_map=center_map)
+        self.outlier_r = outlier_r
+        self.width = width
+        self.jitter = jitter
+        self.max_outliers = max_outliers
+        self.keep_extremes = keep_extremes
+        self.seed = seed
+        self._rows = {'boxes': 1, 'means': 1, 'outliers': max(max_outliers, 2 * keep_extremes)}
+        self.update(df)
+
+    def _build(self, rows):
+        qt, values, counts = self._summary(rows, (.25, .5, .75))
+        sf = boxes_from_quantiles(qt, outlier_r=self.outlier_r)
+        code = np.repeat(np.arange(len(rows)), counts)
+        is_low = values < sf['lower'].to_numpy()[code]
+        is_high = sf['upper'].to_numpy()[code] < values
+        df_ = pd.DataFrame({self.by: np.repeat(sf.index.to_numpy(), counts), self.col: values,
+                            'is_low': is_low, 'is_high': is_high, 'is_outlier': is_low | is_high})
+        out = _box_plot_data(sf, df_, self.by, self.col, self.center_map, width=self.width, jitter=self.jitter,
+                             max_outliers=self.max_outliers, keep_extremes=self.keep_extremes, seed=self.seed)
+
+        # outliers into the fixed slots of their group
+        k = self._rows['outliers']
+        ocode = sf.index.get_indexer(out['outliers']['group'])
+        first = np.searchsorted(ocode, ocode)
+        slot = ocode * k + np.arange(len(ocode)) - first
+        outliers = {}
+        for column in ('x', 'y'):
+            a = np.full(len(rows) * k, np.nan)
+            a[slot] = out['outliers'][column]
+            outliers[column] = a
+        outliers['group'] = np.repeat(sf.index.to_numpy(), k)
+        out['outliers'] = outliers
+
+        return out
+
+
+class LiveQHistograms(_LivePlot):
+    """lattice.qhistograms of a growing DataFrame, updated with stream/patch diffs of the touched groups
+
+        Groups are centered as in qhistograms for integer labels, other labels are placed in
+        order of first appearance. See LiveBoxPlots for an example.
+    """
+    def __init__(self, df, by, col, quantiles=np.arange(0.25, .8, .05), centered=True, width=.8,
+                 center_map=None):
+        assert len(quantiles) > 2
+        super().__init__(by, col, center_map=center_map)
+        self.quantiles = np.sort(quantiles)
+        self.centered = centered
+        self.width = width
+        self._rows = {'histograms': len(self.quantiles) - 1, 'medians': 1}
+        self.update(df)
+
+    def _build(self, rows):
+        qt, _, _ = self._summary(rows, self.quantiles)
+
+        return qhistograms(None, self.by, self.col, quantiles=self.quantiles, centered=self.centered,
+                           center_map=self.center_map, width=self.width, qt=qt)
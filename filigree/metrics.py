@@ -1,7 +1,229 @@
+import inspect
 import numpy as np
 import re
 
+
+def _window_moments(s, starts, ends, weights=None):
+    """Count, mean and standard deviation (ddof=0) of each window s[starts[i]:ends[i]]
+        answered in O(1) per window from prefix sums of s and s ** 2
+
+        With weights, the total weight and moments of s repeated by its weights
+    """
+    s = np.asarray(s, dtype=float)
+    # shifting by the overall mean keeps the prefix sums small and the variance well conditioned
+    shift = s.mean() if len(s) else 0.
+    d = s - shift
+    wd = d if weights is None else np.asarray(weights, dtype=float) * d
+    c1 = np.concatenate([[0.], np.cumsum(wd)])
+    c2 = np.concatenate([[0.], np.cumsum(wd * d)])
+    if weights is None:
+        n = ends - starts
+    else:
+        c0 = np.concatenate([[0.], np.cumsum(weights, dtype=float)])
+        n = c0[ends] - c0[starts]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        m = (c1[ends] - c1[starts]) / n
+        var = (c2[ends] - c2[starts]) / n - m ** 2
+
+    return n, m + shift, np.sqrt(np.maximum(var, 0))
+
+def _window_portion(msk, starts, ends, weights=None):
+    """Portion (of the weight) of True values of each window msk[starts[i]:ends[i]] from a prefix count
+    """
+    if weights is None:
+        c = np.concatenate([[0], np.cumsum(msk)])
+        n = ends - starts
+    else:
+        w = np.asarray(weights, dtype=float)
+        c = np.concatenate([[0.], np.cumsum(w * msk)])
+        c0 = np.concatenate([[0.], np.cumsum(w)])
+        n = c0[ends] - c0[starts]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (c[ends] - c[starts]) / n
+
+def _sliding_sorted(s, starts, ends):
+    """Yield each window s[starts[i]:ends[i]] in sorted order
+
+        While starts and ends are nondecreasing one sorted buffer is kept and only the
+        records leaving and entering the window are deleted/inserted, windows with little
+        overlap with the previous one are sorted from scratch. Yielded arrays must not be modified.
+    """
+    s = np.asarray(s, dtype=float)
+    window = s[:0]
+    lo = hi = 0
+    for a, b in zip(starts, ends):
+        if a < lo or b < hi or a >= hi or (a - lo) + (b - hi) > b - a:
+            window = np.sort(s[a:b])
+        else:
+            if a > lo:
+                leaving = np.sort(s[lo:a])
+                # equal values leaving occupy consecutive slots of the buffer
+                idx = np.searchsorted(window, leaving) + np.arange(len(leaving)) - np.searchsorted(leaving, leaving)
+                window = np.delete(window, idx)
+            if b > hi:
+                entering = np.sort(s[hi:b])
+                window = np.insert(window, np.searchsorted(window, entering), entering)
+        lo, hi = a, b
+        yield window
+
+def _sorted_quantile(s, q, cum_weights=None):
+    """Quantile (linear interpolation as numpy.quantile) of an already sorted array
+
+        With the cumulative weights of s, the quantile of s repeated by its weights
+        (exact for integer weights), nan when the total weight is 0
+    """
+    if not len(s) or (cum_weights is not None and not cum_weights[-1] > 0):
+        return np.nan
+    if cum_weights is not None:
+        pos = q * max(cum_weights[-1] - 1, 0)
+        i = np.floor(pos)
+        lo = min(np.searchsorted(cum_weights, i, side='right'), len(s) - 1)
+        hi = min(np.searchsorted(cum_weights, i + 1, side='right'), len(s) - 1)
+        return s[lo] + (s[hi] - s[lo]) * (pos - i)
+    pos = q * (len(s) - 1)
+    i = int(pos)
+    j = min(i + 1, len(s) - 1)
+
+    return s[i] + (s[j] - s[i]) * (pos - i)
+
+
+class SampleStats(object):
+    """Lazily computed statistics of one sample shared by the metrics evaluated on it
+
+        Each of the sort, the moments (mean and std) and the absolute values is computed at
+        most once, on first use by any metric.
+
+        weights, array-like: default None, weight (e.g. count) of each value, statistics are
+                 those of the values repeated by their weights
+    """
+    def __init__(self, s, is_sorted=False, weights=None):
+        self.values = np.asarray(s, dtype=float)
+        self.weights = None if weights is None else np.asarray(weights, dtype=float)
+        self._sorted = self.values if is_sorted else None
+        self._sorted_weights = self.weights if is_sorted else None
+        self._cum_weights = None
+        self._moments = None
+        self._abs = None
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def total(self):
+        """Number of values, total weight when weighted"""
+        return len(self.values) if self.weights is None else self.weights.sum()
+
+    @property
+    def sorted(self):
+        if self._sorted is None:
+            if self.weights is None:
+                self._sorted = np.sort(self.values)
+            else:
+                order = np.argsort(self.values, kind='stable')
+                self._sorted, self._sorted_weights = self.values[order], self.weights[order]
+        return self._sorted
+
+    @property
+    def cum_weights(self):
+        """Cumulative weights in sorted order, None when unweighted"""
+        if self.weights is not None and self._cum_weights is None:
+            self.sorted  # sorts the weights along
+            self._cum_weights = np.cumsum(self._sorted_weights)
+        return self._cum_weights
+
+    @property
+    def moments(self):
+        """tuple (mean, std) with ddof=0 as numpy.std, nan when the total weight is 0"""
+        if self._moments is None and not self.total > 0:
+            self._moments = (np.nan, np.nan)
+        elif self._moments is None:
+            m = np.average(self.values, weights=self.weights)
+            self._moments = (m, np.sqrt(np.average((self.values - m) ** 2, weights=self.weights)))
+        return self._moments
+
+    @property
+    def abs(self):
+        if self._abs is None:
+            self._abs = np.abs(self.values)
+        return self._abs
+
+    def portion(self, count):
+        """count relative to the total, nan when the total weight is 0"""
+        return count / self.total if self.total > 0 else np.nan
+
+    def count(self, msk):
+        """Number (total weight) of values where msk is True"""
+        return np.count_nonzero(msk) if self.weights is None else self.weights[msk].sum()
+
+    def count_between(self, low, high):
+        """Number (total weight) of values with low <= v <= high, by binary search when already sorted"""
+        if self._sorted is None:
+            return self.count((low <= self.values) & (self.values <= high))
+        a = np.searchsorted(self._sorted, low, side='left')
+        b = np.searchsorted(self._sorted, high, side='right')
+        if self.weights is None:
+            return b - a
+        cw = self.cum_weights
+        return (cw[b - 1] if b else 0.) - (cw[a - 1] if a else 0.)
+
+
+class SegmentStats(object):
+    """Lazily computed statistics of every segment values[offsets[i]:offsets[i + 1]] of an array
+        sorted by group (and by value within groups, as tools.group_sort returns it), shared by
+        the metrics evaluated on the segments; each is computed once with segment reductions
+
+        weights, array-like: default None, weight of each value (aligned with values)
+    """
+    def __init__(self, values, offsets, weights=None):
+        self.values = np.asarray(values, dtype=float)
+        self.offsets = np.asarray(offsets)
+        self.weights = None if weights is None else np.asarray(weights, dtype=float)
+        self.counts = np.diff(self.offsets)
+        self.totals = self.counts if weights is None else self.sum(self.weights)
+        self._moments = None
+        self._abs = None
+
+    def __len__(self):
+        return len(self.counts)
+
+    def sum(self, values):
+        # imported here as filigree.tools imports this module
+        from filigree.tools import segment_sum
+        return segment_sum(values, self.offsets)
+
+    def quantiles(self, quantiles):
+        from filigree.tools import segment_quantiles
+        return segment_quantiles(self.values, self.offsets, quantiles, weights=self.weights)
+
+    def _weighted(self, values):
+        return values if self.weights is None else values * self.weights
+
+    @property
+    def moments(self):
+        """tuple (mean, std) of np.arrays with ddof=0 as numpy.std"""
+        if self._moments is None:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                m = self.sum(self._weighted(self.values)) / self.totals
+                dev = (self.values - np.repeat(m, self.counts)) ** 2
+                self._moments = (m, np.sqrt(self.sum(self._weighted(dev)) / self.totals))
+        return self._moments
+
+    @property
+    def abs(self):
+        if self._abs is None:
+            self._abs = np.abs(self.values)
+        return self._abs
+
+    def portion(self, msk):
+        """Portion (of the weight) of True values of msk (aligned with values) in every segment"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum(self._weighted(msk.astype(float))) / self.totals
+
+
 class ABCMetric(object):
+    # windows() with weights runs in O(len(s) + len(starts)), rather than once per window
+    _weighted_windows = False
+
     def __init__(self, *params, **kwargs):
         self._acronym = ''.join(c.lower() for c in self.__class__.__name__ if 65 <= ord(c) and ord(c) <= 90)
         self.params = params
@@ -35,8 +257,69 @@ class ABCMetric(object):
 
         return re.sub('[()]', '', re.sub('[.-]', '_', name))
 
+    def _weighted_call(self, s, weights, takes_weights=None):
+        """self(s, weights=weights), for a __call__ without weights s repeated by its weights,
+            which must then be integer counts; nan when the total weight is 0
+        """
+        takes_weights = ('weights' in inspect.signature(self.__call__).parameters
+                         if takes_weights is None else takes_weights)
+        if takes_weights:
+            return self(s, weights=weights)
+        weights = np.asarray(weights, dtype=float)
+        if not (weights == np.round(weights)).all():
+            raise TypeError(f'{self.__class__.__name__}.__call__ takes no weights, '
+                            'they must then be integer counts to repeat the values by')
+        if not weights.sum():
+            return np.nan
+
+        return self(np.repeat(s, weights.astype(np.int64)))
+
+    def from_stats(self, st):
+        """Evaluate the metric from a SampleStats, subclasses reuse its shared statistics"""
+        return self(st.values) if st.weights is None else self._weighted_call(st.values, st.weights)
+
+    def from_segment_stats(self, sst):
+        """Evaluate the metric on every segment of a SegmentStats, nan for empty segments
+
+            Subclasses compute all segments at once with segment reductions, this default
+            calls the metric once per segment.
+        """
+        if sst.weights is not None:
+            takes_weights = 'weights' in inspect.signature(self.__call__).parameters
+            return np.array([self._weighted_call(sst.values[a:b], sst.weights[a:b], takes_weights)
+                             if b > a else np.nan
+                             for a, b in zip(sst.offsets[:-1], sst.offsets[1:])], dtype=float)
+        return np.array([self(sst.values[a:b]) if b > a else np.nan
+                         for a, b in zip(sst.offsets[:-1], sst.offsets[1:])], dtype=float)
+
+    def segments(self, values, offsets, weights=None):
+        """Evaluate the metric on every segment values[offsets[i]:offsets[i + 1]] of values sorted
+            by group (and by value within each group), e.g. from tools.group_sort
+
+            return: np.array with one value per segment
+        """
+        return self.from_segment_stats(SegmentStats(values, offsets, weights=weights))
+
+    def windows(self, s, starts, ends, weights=None):
+        """Evaluate the metric on every window s[starts[i]:ends[i]], nan for empty windows
+
+            Subclasses override this with a vectorized or incremental version; starts and ends
+            are expected nondecreasing (as windows sliding along sorted x) for those to be fast.
+
+            weights, array-like: default None, weight of each value of s, see SampleStats
+        """
+        s = np.asarray(s)
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float)
+            takes_weights = 'weights' in inspect.signature(self.__call__).parameters
+            return np.array([self._weighted_call(s[a:b], weights[a:b], takes_weights) if b > a else np.nan
+                             for a, b in zip(starts, ends)], dtype=float)
+        return np.array([self(s[a:b]) if b > a else np.nan for a, b in zip(starts, ends)], dtype=float)
+
 
 class SigmaOffset(ABCMetric):
+    _weighted_windows = True
+
     def __init__(self, sigma, name=None):
         assert np.abs(sigma) < 4
         super().__init__(sigma, name=name)
@@ -45,10 +328,24 @@ class SigmaOffset(ABCMetric):
     def sigma(self):
         return self.params[0]
 
-    def __call__(self, s):
+    def __call__(self, s, weights=None):
+        if weights is not None:
+            return self.from_stats(SampleStats(s, weights=weights))
         return np.mean(s) + self.sigma * np.std(s)
+
+    def from_stats(self, st):
+        m, sd = st.moments
+        return m + self.sigma * sd
+
+    from_segment_stats = from_stats
+
+    def windows(self, s, starts, ends, weights=None):
+        _, m, sd = _window_moments(s, starts, ends, weights=weights)
+        return m + self.sigma * sd
     
 class SigmaRadius(ABCMetric):
+    _weighted_windows = True
+
     def __init__(self, sigmar, name=None):
         assert 0 < sigmar and sigmar < 4
         super().__init__(sigmar, name=name)
@@ -60,8 +357,17 @@ class SigmaRadius(ABCMetric):
     def sigmar(self):
         return self.params[0]
     
-    def __call__(self, s):
-        return self.get_high_offset(s) - self.get_low_offset(s)
+    def __call__(self, s, weights=None):
+        return self.from_stats(SampleStats(s, weights=weights))
+
+    def from_stats(self, st):
+        return self.get_high_offset.from_stats(st) - self.get_low_offset.from_stats(st)
+
+    from_segment_stats = from_stats
+
+    def windows(self, s, starts, ends, weights=None):
+        _, m, sd = _window_moments(s, starts, ends, weights=weights)
+        return (m + self.sigmar * sd) - (m - self.sigmar * sd)
     
     
 class Quantile(ABCMetric):
@@ -73,8 +379,21 @@ class Quantile(ABCMetric):
     def q(self):
         return self.params[0]
     
-    def __call__(self, s):
+    def __call__(self, s, weights=None):
+        if weights is not None:
+            return self.from_stats(SampleStats(s, weights=weights))
         return np.quantile(s, self.q)
+
+    def from_stats(self, st):
+        return _sorted_quantile(st.sorted, self.q, st.cum_weights)
+
+    def from_segment_stats(self, sst):
+        return sst.quantiles([self.q])[:, 0]
+
+    def windows(self, s, starts, ends, weights=None):
+        if weights is not None:
+            return super().windows(s, starts, ends, weights=weights)
+        return np.array([_sorted_quantile(w, self.q) for w in _sliding_sorted(s, starts, ends)])
     
 class QuantileRange(ABCMetric):
     def __init__(self, qlow, qhigh, name=None):
@@ -94,10 +413,25 @@ class QuantileRange(ABCMetric):
     def qhigh(self):
         return self.params[1]
     
-    def __call__(self, s):
-        return self.get_high_quantile(s) - self.get_low_quantile(s)
+    def __call__(self, s, weights=None):
+        return self.from_stats(SampleStats(s, weights=weights))
+
+    def from_stats(self, st):
+        return self.get_high_quantile.from_stats(st) - self.get_low_quantile.from_stats(st)
+
+    def from_segment_stats(self, sst):
+        qs = sst.quantiles([self.qlow, self.qhigh])
+        return qs[:, 1] - qs[:, 0]
+
+    def windows(self, s, starts, ends, weights=None):
+        if weights is not None:
+            return super().windows(s, starts, ends, weights=weights)
+        return np.array([_sorted_quantile(w, self.qhigh) - _sorted_quantile(w, self.qlow)
+                         for w in _sliding_sorted(s, starts, ends)])
     
 class PortionInBounds(ABCMetric):
+    _weighted_windows = True
+
     def __init__(self, low, high, name=None):
         assert low < high
         super().__init__(low, high, name=name)
@@ -110,11 +444,25 @@ class PortionInBounds(ABCMetric):
     def high(self):
         return self.params[1]
     
-    def __call__(self, s):
+    def __call__(self, s, weights=None):
+        if weights is not None:
+            return self.from_stats(SampleStats(s, weights=weights))
         s = np.array(s)
         return ((self.low <= s) & (s <= self.high)).sum() / len(s)
+
+    def from_stats(self, st):
+        return st.portion(st.count_between(self.low, self.high))
+
+    def from_segment_stats(self, sst):
+        return sst.portion((self.low <= sst.values) & (sst.values <= self.high))
+
+    def windows(self, s, starts, ends, weights=None):
+        s = np.asarray(s)
+        return _window_portion((self.low <= s) & (s <= self.high), starts, ends, weights=weights)
     
 class PortionInRadius(ABCMetric):
+    _weighted_windows = True
+
     def __init__(self, r, name=None):
         assert 0 < r
         super().__init__(r)
@@ -123,6 +471,166 @@ class PortionInRadius(ABCMetric):
     def r(self):
         return self.params[0]
     
-    def __call__(self, s):
+    def __call__(self, s, weights=None):
+        if weights is not None:
+            return self.from_stats(SampleStats(s, weights=weights))
         s = np.array(s)
         return (np.abs(s) <= self.r).sum() / len(s)
+
+    def from_stats(self, st):
+        if st._sorted is None:
+            return st.portion(st.count(st.abs <= self.r))
+        return st.portion(st.count_between(-self.r, self.r))
+
+    def from_segment_stats(self, sst):
+        return sst.portion(sst.abs <= self.r)
+
+    def windows(self, s, starts, ends, weights=None):
+        return _window_portion(np.abs(np.asarray(s)) <= self.r, starts, ends, weights=weights)
+
+
+
+class MetricSet(object):
+    """Evaluate many metrics on the same sample sharing one sort, one moments pass and one
+        absolute value pass (see SampleStats)
+
+        Args:
+            metrics, ABCMetric: metric instances, results are keyed by each metric's __name__
+
+        Example:
+            ms = MetricSet(Quantile(.1), Quantile(.9), SigmaRadius(1), PortionInRadius(2))
+            ms(residuals)  # {'q0_1': ..., 'q0_9': ..., 'sr1': ..., 'pir2': ...}
+    """
+    def __init__(self, *metrics):
+        self.metrics = list(metrics)
+
+    @property
+    def names(self):
+        return [m.__name__ for m in self.metrics]
+
+    def from_stats(self, st):
+        return {m.__name__: m.from_stats(st) for m in self.metrics}
+
+    def __call__(self, s, weights=None):
+        return self.from_stats(SampleStats(s, weights=weights))
+
+    def segments(self, sorted_values, offsets, weights=None):
+        """Evaluate every metric on every segment sorted_values[offsets[i]:offsets[i + 1]]
+            (values sorted within segments, as tools.group_sort returns them) sharing one
+            SegmentStats, metrics without segment reductions are called once per segment
+
+            return: dict of metric name to np.array with one value per segment
+        """
+        sst = SegmentStats(sorted_values, offsets, weights=weights)
+
+        return {m.__name__: m.from_segment_stats(sst) for m in self.metrics}
+
+
+class SliceStats(object):
+    """Sufficient statistics of targets y and predictions yhat in every cell (bin of feature i,
+        bin of feature j) of every pair of binned features (see tools.bin_features)
+
+        Cells of all pairs of a feature are counted with one np.bincount per statistic on
+        combined codes (pair * n_bins + bin_i) * n_bins + bin_j, rows in chunks of at most
+        `chunk_size` codes. Arrays of shape (n_pairs, n_bins, n_bins): n, sy, syy (sums of y and
+        y ** 2), sr, srr (sums of the residual yhat - y and its square), correct (y == yhat) and
+        the binary confusion counts tp, fp, fn (label 1 positive).
+
+        Args:
+            codes, np.array(int): shape (n_records, n_features), bin of each feature, -1 for missing
+            threshold, numeric: default None compares labels, otherwise yhat >= threshold is the
+                     predicted label (e.g. for probabilities)
+            statistics, iterable: default all, the statistics to count, e.g. SliceStats.requires['r2']
+
+        Example:
+            codes, labels = bin_features(df, features)
+            st = SliceStats(codes, df.y, df.yhat)
+            st.metric('r2')[st.pair_index(0, 3)]  # r2 in every bin of features 0 and 3
+    """
+    statistics = ('n', 'sy', 'syy', 'sr', 'srr', 'correct', 'tp', 'fp', 'fn')
+    requires = {'n': ('n',), 'mse': ('n', 'srr'), 'r2': ('n', 'sy', 'syy', 'srr'), 'bias': ('n', 'sr'),
+                'accuracy': ('n', 'correct'), 'f1': ('n', 'tp', 'fp', 'fn')}
+
+    def __init__(self, codes, y, yhat, n_bins=None, threshold=None, statistics=None, chunk_size=2 ** 22):
+        codes = np.asarray(codes)
+        y = np.asarray(y, dtype=float)
+        yhat = np.asarray(yhat, dtype=float)
+        n_features = codes.shape[1]
+        self.n_bins = int(codes.max()) + 1 if n_bins is None else n_bins
+        self.pairs = np.array([(i, j) for i in range(n_features) for j in range(i + 1, n_features)],
+                              dtype=np.int64).reshape(-1, 2)
+
+        statistics = set(self.statistics if statistics is None else statistics) | {'n'}
+        label = yhat if threshold is None else (yhat >= threshold).astype(float)
+        weights = {'n': lambda: None, 'sy': lambda: y, 'syy': lambda: y * y, 'sr': lambda: yhat - y,
+                   'srr': lambda: (yhat - y) ** 2, 'correct': lambda: (y == label).astype(float),
+                   'tp': lambda: ((y == 1) & (label == 1)).astype(float),
+                   'fp': lambda: ((y != 1) & (label == 1)).astype(float),
+                   'fn': lambda: ((y == 1) & (label != 1)).astype(float)}
+        weights = {name: weights[name]() for name in self.statistics if name in statistics}
+
+        # cells with a missing bin are counted in an extra last cell and dropped
+        size = len(self.pairs) * self.n_bins ** 2
+        sums = {name: np.zeros(size + 1) for name in weights}
+        first = 0
+        for i in range(n_features - 1):
+            m = n_features - 1 - i
+            pair = np.arange(first, first + m).reshape(1, -1)
+            first += m
+            step = max(chunk_size // m, 1)
+            for a in range(0, len(codes), step):
+                ci, cj = codes[a:a + step, i:i + 1], codes[a:a + step, i + 1:]
+                cell = (pair * self.n_bins + ci) * self.n_bins + cj
+                cell[(ci < 0) | (cj < 0)] = size
+                cell = cell.ravel()
+                for name, w in weights.items():
+                    if w is not None:
+                        w = np.repeat(w[a:a + step], m)
+                    sums[name] += np.bincount(cell, w, minlength=size + 1)
+
+        shape = (len(self.pairs), self.n_bins, self.n_bins)
+        for name in weights:
+            setattr(self, name, sums[name][:size].reshape(shape))
+
+    def pair_index(self, i, j):
+        """Position of the pair of features i < j in the first axis of the statistics"""
+        return int(np.flatnonzero((self.pairs[:, 0] == i) & (self.pairs[:, 1] == j))[0])
+
+    def mse(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.srr / self.n
+
+    def r2(self):
+        """Coefficient of determination 1 - SS_res / SS_tot of every cell"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return 1 - self.srr / (self.syy - self.sy ** 2 / self.n)
+
+    def bias(self):
+        """Mean residual yhat - y of every cell"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sr / self.n
+
+    def accuracy(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.correct / self.n
+
+    def f1(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return 2 * self.tp / (2 * self.tp + self.fp + self.fn)
+
+    def metric(self, metric):
+        """Array of shape (n_pairs, n_bins, n_bins) of a metric, nan for empty cells
+
+            Args:
+                metric, str or function: 'r2', 'mse', 'bias', 'accuracy', 'f1', 'n', or
+                         function(SliceStats) returning the array
+        """
+        if callable(metric):
+            values = metric(self)
+        elif metric == 'n':
+            values = self.n
+        else:
+            assert metric in ('r2', 'mse', 'bias', 'accuracy', 'f1'), metric
+            values = getattr(self, metric)()
+
+        return np.where(self.n > 0, values, np.nan)
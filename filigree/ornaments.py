@@ -2,10 +2,12 @@ import numpy as np
 from copy import copy
 
 from bokeh.layouts import Column, Row, Spacer
-from bokeh.plotting import Figure
-from bokeh.models import Circle, HoverTool, ColumnDataSource, Range1d
+from bokeh.plotting import Figure, figure
+from bokeh.models import Circle, HoverTool, ColumnDataSource, Range1d, LogColorMapper
 
-from filigree.colors import get_colors_hex
+from filigree.colors import get_colors_hex, random_rgb, mix_colors, hex_to_rgb, rgb_to_hex
+from filigree.lattice import slice_heatmap, pair_histograms
+from filigree.profiling import profiled
 
 
 def color_plot(colors, width=720, height=180):
@@ -20,8 +22,24 @@ def color_plot(colors, width=720, height=180):
     return f
 
 
+@profiled('bokeh', groups=lambda r: len(r.children))
 def scatter_matrix(df, xcols=None, ycols=None, width=None, height=None, margin=0, all_range=None, 
-                   source=None, full=False, colors=None, include_hist=False, tooltips=None, **sckwargs):
+                   source=None, full=False, colors=None, include_hist=False, tooltips=None,
+                   max_points=200000, bins=100, n_sample=5000, density_palette='Greys256', seed=0, **sckwargs):
+    """Grid of scatter plots of ycols against xcols sharing one source, so a selection in one
+        panel shows in all of them
+
+        Only the plotted columns are sent, as float32 arrays. Above max_points rows every panel
+        is drawn as an image of its 2d histogram (computed from one binning of every column,
+        see lattice.pair_histograms) with a random sample of n_sample points on top for hover
+        and selection.
+
+        Args:
+            max_points, int: largest number of rows drawn as points, None for no limit
+            bins, int: histogram bins per column
+            n_sample, int: rows sampled for the points over the histograms
+            density_palette, str or list: palette of the histogram images, log scaled counts
+    """
     
     if xcols is None and ycols is not None:
         ycols = copy(ycols)
@@ -42,10 +60,6 @@ def scatter_matrix(df, xcols=None, ycols=None, width=None, height=None, margin=0
     if tooltips is not None and tooltips == 'auto':
         tooltips = [(col, f"@{col}") for col in cols]
     
-    colors = dict(zip(cols, random_rgb(len(cols))))
-    xcolors = mix_colors({c: colors[c] for c in xcols},
-                         {c: colors[c] for c in ycols})
-    
     ncols = len(xcols)
     nrows = len(ycols)
     
@@ -53,8 +67,19 @@ def scatter_matrix(df, xcols=None, ycols=None, width=None, height=None, margin=0
     width = 240 if width is None else width
     height = 180 if height is None else height
     
-    if source is None or any([ncols > 2, nrows > 2]):
-        fsource = ColumnDataSource(data={c: df[c].values for c in df.columns})
+    binned = max_points is not None and len(df) > max_points
+    if binned:
+        sample = np.sort(np.random.default_rng(seed).choice(len(df), min(n_sample, len(df)), replace=False))
+        pairs = [(xcol, ycol) for i, ycol in enumerate(ycols) for j, xcol in enumerate(xcols) if i >= j or full]
+        hists = pair_histograms(df, pairs, bins=bins)
+        cmap = LogColorMapper(palette=density_palette, nan_color=(0, 0, 0, 0))
+    else:
+        sample = slice(None)
+    if source is None:
+        # only the plotted columns, float32 numpy arrays are sent to the browser as binary buffers
+        fsource = ColumnDataSource(data={c: df[c].to_numpy(dtype=np.float32)[sample] for c in cols})
+    else:
+        fsource = source
 
     if colors is None:
         colors = dict(zip(cols, random_rgb(len(cols))))
@@ -75,6 +100,12 @@ def scatter_matrix(df, xcols=None, ycols=None, width=None, height=None, margin=0
                 light_color = rgb_to_hex(scolor * sgrey) # ** 4 ** md)
                 color = rgb_to_hex(scolor)
                 g = Figure(width=width, height=height, tools='box_select,wheel_zoom', toolbar_location=None)
+                if binned:
+                    counts = hists['counts'][xcol, ycol].T.astype(float)
+                    counts[counts == 0] = np.nan
+                    xe, ye = hists['edges'][xcol], hists['edges'][ycol]
+                    g.image(image=[counts], x=xe[0], y=ye[0], dw=xe[-1] - xe[0], dh=ye[-1] - ye[0],
+                            color_mapper=cmap)
                 glyph = g.circle(x=xcol, y=ycol, source=fsource, color=color, **sckwargs)
                 glyph.selection_glyph = Circle(fill_alpha=np.sqrt(sckwargs.get('alpha', 1)), fill_color=color, line_color=None)
                 glyph.nonselection_glyph = Circle(fill_alpha=1, fill_color='#EAEAEA', line_color=light_color,
@@ -93,5 +124,24 @@ def scatter_matrix(df, xcols=None, ycols=None, width=None, height=None, margin=0
 
     return Column(*rows)
 
-#TODO # method to plot pairwise feature slice metrics of f(y, yhat) for analyzing ML model performance
-# possible default heatmaps r2_score, accuracy_score/f1_score, deviation from fitted normal distribution
+
+@profiled('bokeh')
+def slice_metric_heatmap(df, features, y, yhat, metric='r2', width=720, height=720, tooltips='auto', **kwargs):
+    """Figure of the pairwise feature slice heatmaps of a model metric f(y, yhat), one block per
+        pair of features, see lattice.slice_heatmap for metric and kwargs
+    """
+    data = slice_heatmap(df, features, y, yhat, metric=metric, **kwargs)
+    if tooltips == 'auto':
+        tooltips = [(metric if isinstance(metric, str) else 'metric', '@value'), ('n', '@n'),
+                    ('x', '@xfeature: @xbin'), ('y', '@yfeature: @ybin')]
+
+    f = figure(width=width, height=height, tools='pan,wheel_zoom,reset', match_aspect=True)
+    f.patches('x', 'y', color='color', source=ColumnDataSource(data=data['heatmap']))
+    f.add_tools(HoverTool(tooltips=tooltips))
+    f.xaxis.ticker = list(data['xticks'])
+    f.xaxis.major_label_overrides = data['xticks']
+    f.yaxis.ticker = list(data['yticks'])
+    f.yaxis.major_label_overrides = data['yticks']
+    f.grid.visible = False
+
+    return f
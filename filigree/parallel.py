@@ -0,0 +1,124 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from filigree.fretwork import boxes_from_quantiles
+from filigree.profiling import profiled
+from filigree.sketches import QuantileSketch
+from filigree.tools import quantile_label, sort_segments, segment_summary
+
+
+def _to_shared(a, order=None):
+    """Shared memory copy of a, or of a[order]"""
+    shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+    out = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+    if order is None:
+        out[:] = a
+    else:
+        np.take(a, order, out=out)
+
+    return shm
+
+def _shard_rows(codes, large, n_shards):
+    """Order of the rows grouped by shard and offsets of the shards' row ranges
+
+        Rows of groups not flagged `large` go to the shard their code hashes to, rows of large
+        groups are split evenly across the shards. Within every shard the rows to summarize
+        exactly come first, so shard i summarizes rows offsets[2 * i]:offsets[2 * i + 1] exactly
+        and sketches rows offsets[2 * i + 1]:offsets[2 * i + 2].
+    """
+    big = large[codes]
+    rank = np.cumsum(big) - 1
+    shard = np.where(big, rank * n_shards // max(int(big.sum()), 1), codes % n_shards)
+    # a stable sort of 16 bit keys is a linear time radix sort
+    key = (2 * shard + big).astype(np.int16 if n_shards < 2 ** 14 else np.int64)
+    order = np.argsort(key, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(key, minlength=2 * n_shards))])
+
+    return order, offsets
+
+def _summarize_shard(codes_name, values_name, n, start, mid, end, quantiles, compression):
+    """Partial summary of one shard, run in a worker process
+
+        Rows [start, mid) of the shared arrays are whole groups, summarized exactly, rows
+        [mid, end) are part of large groups, added to a QuantileSketch to be merged by the parent.
+    """
+    codes_shm = shared_memory.SharedMemory(name=codes_name)
+    values_shm = shared_memory.SharedMemory(name=values_name)
+    try:
+        codes = np.ndarray((n, ), dtype=np.int64, buffer=codes_shm.buf)
+        values = np.ndarray((n, ), dtype=np.float64, buffer=values_shm.buf)
+
+        groups, c = np.unique(codes[start:mid], return_inverse=True)
+        summary = segment_summary(*sort_segments(c.ravel(), values[start:mid], len(groups)), quantiles=quantiles)
+
+        sketch = None
+        if end > mid:
+            sketch = QuantileSketch('code', 'value', compression=compression).update(
+                pd.DataFrame({'code': codes[mid:end], 'value': values[mid:end]}))
+    finally:
+        codes_shm.close()
+        values_shm.close()
+
+    return groups, summary, sketch
+
+@profiled('aggregation')
+def parallel_calculate_quantiles(df, by, col, quantiles=(.25, .5, .75), n_workers=None,
+                                 exact_limit=None, compression=200):
+    """tools.calculate_quantiles across a process pool
+
+        Group codes and values are written once to shared memory, grouped by shard, and each
+        worker reads its contiguous row range in place. Groups are sharded by hash and summarized
+        exactly; groups with more than `exact_limit` records are instead split evenly across
+        every worker, sketched (see sketches.QuantileSketch) and the partial sketches merged.
+
+        Args:
+            n_workers, int: default os.cpu_count(), number of processes
+            exact_limit, int: default None summarizes every group exactly
+            compression, numeric: accuracy of the sketches of large groups
+
+        return: pandas.DataFrame with the schema of tools.calculate_quantiles
+    """
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    values = df[col].to_numpy(dtype=float)
+    codes, groups = pd.factorize(df[by], sort=True)
+    keep = (codes >= 0) & ~np.isnan(values)
+    codes, values = codes[keep].astype(np.int64), values[keep]
+    counts = np.bincount(codes, minlength=len(groups))
+    large = np.zeros(len(groups), dtype=bool) if exact_limit is None else counts > exact_limit
+
+    order, offsets = _shard_rows(codes, large, n_workers)
+    codes_shm, values_shm = _to_shared(codes, order), _to_shared(values, order)
+    del order
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            parts = list(pool.map(_summarize_shard, *zip(*[
+                (codes_shm.name, values_shm.name, len(codes), *offsets[2 * i:2 * i + 3].tolist(), quantiles, compression)
+                for i in range(n_workers)])))
+    finally:
+        for shm in (codes_shm, values_shm):
+            shm.close()
+            shm.unlink()
+
+    frames = [pd.DataFrame(summary, index=g) for g, summary, _ in parts if len(g)]
+    sketches = [sk for _, _, sk in parts if sk is not None]
+    if sketches:
+        for sk in sketches[1:]:
+            sketches[0].merge(sk)
+        frames.append(sketches[0].calculate_quantiles(quantiles))
+
+    columns = ['qmin', 'qmax', 'qmedian', 'mu', 'n_records'] + [quantile_label(q) for q in quantiles]
+    qt = (pd.concat(frames) if frames else pd.DataFrame(columns=columns)).sort_index()
+    qt.index = pd.Index(groups[qt.index.to_numpy(dtype=np.int64)], name=by)
+
+    return qt[columns]
+
+def parallel_calculate_boxes(df, by, col, outlier_r=1.5, **kwargs):
+    """fretwork.calculate_boxes across a process pool, see parallel_calculate_quantiles
+        (n_records counts non-null values)
+    """
+    return boxes_from_quantiles(parallel_calculate_quantiles(df, by, col, quantiles=(.25, .5, .75), **kwargs),
+                                outlier_r=outlier_r)
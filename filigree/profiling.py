@@ -0,0 +1,165 @@
+import functools
+import logging
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+_hooks = []
+_profiles = []
+# stages running in the current thread, innermost last
+_local = threading.local()
+
+
+def add_hook(hook):
+    """Register hook(record) called with the record dict of every profiled stage
+    """
+    _hooks.append(hook)
+
+    return hook
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+def log_hook(logger=None, level=logging.DEBUG):
+    """Hook logging every stage record, register with add_hook(log_hook())
+    """
+    logger = logging.getLogger('filigree') if logger is None else logger
+
+    def hook(record):
+        logger.log(level, "%(stage)s %(function)s %(seconds).6fs self=%(self_seconds).6fs rows=%(rows)s groups=%(groups)s bytes=%(bytes)s",
+                   record)
+
+    return hook
+
+def _rows(args, kwargs):
+    data = args[0] if args else kwargs.get('df')
+    try:
+        return len(data)
+    except TypeError:
+        return None
+
+def _groups(result):
+    # summary tables are indexed by group
+    return len(result) if hasattr(result, 'index') and hasattr(result, 'columns') else None
+
+def _run(stage, func, groups, args, kwargs):
+    tracing = tracemalloc.is_tracing()
+    frames = _local.__dict__.setdefault('frames', [])
+    frame = {'child_peak': 0, 'child_seconds': 0.}
+    if tracing:
+        frame['start'], frame['outer_peak'] = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+    frames.append(frame)
+    t = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - t
+        frames.pop()
+        if frames:
+            frames[-1]['child_seconds'] += seconds
+
+    nbytes = None
+    if tracing:
+        peak = max(tracemalloc.get_traced_memory()[1], frame['child_peak'])
+        nbytes = peak - frame['start']
+        if frames:
+            # reset_peak above hid the peak reached by the enclosing stage so far
+            frames[-1]['child_peak'] = max(frames[-1]['child_peak'], peak, frame['outer_peak'])
+
+    record = {'stage': stage, 'function': func.__qualname__, 'seconds': seconds,
+              'self_seconds': seconds - frame['child_seconds'],
+              'rows': _rows(args, kwargs), 'groups': (groups or _groups)(result), 'bytes': nbytes}
+    for hook in _hooks:
+        hook(record)
+    for profile in _profiles:
+        profile.records.append(record)
+
+    return result
+
+def profiled(stage, groups=None):
+    """Decorate a function as a stage of the plot data pipeline
+
+        Calls are timed and recorded only while a Profile is active or a hook is registered,
+        otherwise the only overhead is one check of two lists.
+
+        Args:
+            stage, str: 'aggregation', 'geometry', 'outliers' or 'bokeh'
+            groups: default counts the rows of a DataFrame result, function(result) giving
+                     the number of groups otherwise
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not (_hooks or _profiles):
+                return func(*args, **kwargs)
+            return _run(stage, func, groups, args, kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+class Profile(object):
+    """Record the profiled stages run in a with block
+
+        Each record holds stage, function, seconds (including profiled stages called from it),
+        self_seconds (excluding them), rows (length of the input), groups and bytes (peak
+        memory allocated during the call when memory=True, else None). Nesting is tracked per
+        thread, so stages run in worker threads (batch_plots) do not nest into each other.
+
+        Args:
+            memory, bool: trace allocations with tracemalloc (slows numpy code down noticeably)
+
+        Example:
+            with Profile(memory=True) as prof:
+                box_plots(df, 'hour', 'residual')
+            prof.to_dict()  # {'aggregation': {'calls': 1, 'seconds': ...}, 'outliers': ...}
+            prof.log()
+    """
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.records = []
+        self._tracing = False
+
+    def __enter__(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        _profiles.append(self)
+
+        return self
+
+    def __exit__(self, *exc):
+        _profiles.remove(self)
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def to_dict(self):
+        """Totals per stage: calls, seconds, self_seconds, rows, groups and the largest bytes of
+            a call
+
+            seconds of nested stages are counted in each enclosing stage too, self_seconds are
+            not, so the self_seconds of all stages add up to the profiled time
+        """
+        stages = OrderedDict()
+        for r in self.records:
+            s = stages.setdefault(r['stage'], {'calls': 0, 'seconds': 0., 'self_seconds': 0., 'rows': 0,
+                                               'groups': 0, 'bytes': None})
+            s['calls'] += 1
+            s['seconds'] += r['seconds']
+            s['self_seconds'] += r['self_seconds']
+            s['rows'] += r['rows'] or 0
+            s['groups'] += r['groups'] or 0
+            if r['bytes'] is not None:
+                s['bytes'] = max(s['bytes'] or 0, r['bytes'])
+
+        return dict(stages)
+
+    def log(self, logger=None, level=logging.INFO):
+        logger = logging.getLogger('filigree') if logger is None else logger
+        for stage, s in self.to_dict().items():
+            logger.log(level, "%s calls=%d %.6fs self=%.6fs rows=%d groups=%d bytes=%s",
+                       stage, s['calls'], s['seconds'], s['self_seconds'], s['rows'], s['groups'], s['bytes'])
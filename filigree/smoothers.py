@@ -1,15 +1,31 @@
+import warnings
+
 import numpy as np
-from scipy.stats import distributions
-#from filigree.metrics import SigmaOffset, Quantile
+from filigree.metrics import Quantile
 
 def QuantileSmoother(x, y, q, window=None):
     return MetricSmoother(x, y, Quantile(q), window=window)
 
 
 class ABCSmoother(object):
+    """Smoothed y as a function of x, subclasses implement _evaluate(x) for an array x
+
+        After fit() calls are answered by linear interpolation of the curve precomputed on a
+        grid over the data range (points outside it are evaluated exactly). The grid is
+        refined until interpolating it misses the exact curve at the midpoints between grid
+        points by at most tol (relative to the range of the curve). The fitted curve is
+        dropped when window or any other parameter in _key() changes and refitted with the
+        same settings on the next call.
+    """
     def __init__(self, x, y, window=None):
-        self._x = x
-        self._y = y
+        self._x = np.asarray(x)
+        self._y = np.asarray(y)
+        # data sorted by x once so windows are found with searchsorted
+        self._order = np.argsort(self._x, kind='stable')
+        self._xs = self._x[self._order]
+        self._ys = self._y[self._order]
+        self._fit_args = None
+        self._fitted = None
         self.window = window
         
     @property
@@ -19,34 +35,196 @@ class ABCSmoother(object):
     @window.setter
     def window(self, window):
         if window is None:
-            _x = np.sort(self._x)
-            max_d = max(_x[1:] - _x[:-1])
+            _x = self._xs
+            max_d = np.diff(_x).max() if len(_x) > 1 else 0
             x_range = _x[-1] - _x[0]
             self._window = max(x_range / 20, 1.05 * max_d)
         else:
             self._window = window
+        self._fitted = None
+
+    def _key(self):
+        """Parameters the fitted curve depends on"""
+        return (self._window,)
+
+    def _evaluate(self, x):
+        raise NotImplementedError
+
+    def fit(self, grid_size=1024, tol=1e-3, max_grid_size=2 ** 16):
+        """Precompute the curve on a grid of at least grid_size points over the data range,
+            doubled (reusing all evaluated points) until the interpolation error is at most tol
+
+            Args:
+                tol, float: largest interpolation error at grid midpoints relative to the
+                     range of the curve, None keeps the first grid
+                max_grid_size, int: the grid is not refined beyond this size, a RuntimeWarning
+                     is issued when tol is not reached by then
+
+            return: self, with `error` the relative interpolation error reached
+        """
+        assert grid_size > 1
+        self._fit_args = (grid_size, tol, max_grid_size)
+        grid = np.linspace(self._xs[0], self._xs[-1], grid_size)
+        values = self._evaluate(grid)
+        with np.errstate(invalid='ignore'):
+            while True:
+                mids = (grid[1:] + grid[:-1]) / 2
+                exact = self._evaluate(mids)
+                scale = np.nanmax(values) - np.nanmin(values) if np.isfinite(values).any() else 0
+                miss = np.abs(exact - (values[1:] + values[:-1]) / 2)
+                self.error = np.nanmax(miss) / scale if scale > 0 and np.isfinite(miss).any() else 0.
+                grid = np.append(np.column_stack([grid[:-1], mids]).ravel(), grid[-1])
+                values = np.append(np.column_stack([values[:-1], exact]).ravel(), values[-1])
+                if tol is None or self.error <= tol:
+                    break
+                if 2 * len(grid) - 1 > max_grid_size:
+                    warnings.warn(f'{self.__class__.__name__}.fit stopped at max_grid_size={max_grid_size} '
+                                  f'with interpolation error {self.error:.3g} > tol={tol:.3g}, '
+                                  'raise max_grid_size or tol', RuntimeWarning, stacklevel=2)
+                    break
+        self._fitted = (self._key(), grid, values)
+
+        return self
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=float)
+        if self._fitted is not None and self._fitted[0] != self._key():
+            self._fitted = None
+        if self._fitted is None and self._fit_args is not None:
+            self.fit(*self._fit_args)
+        if self._fitted is None:
+            return self._evaluate(x)
+
+        _, grid, values = self._fitted
+        inside = (grid[0] <= x) & (x <= grid[-1])
+        y = np.empty(len(x))
+        y[inside] = np.interp(x[inside], grid, values)
+        if not inside.all():
+            y[~inside] = self._evaluate(x[~inside])
+
+        return y
 
 class MetricSmoother(ABCSmoother):
     def __init__(self, x, y, metric, window=None):
+        self._metric = metric
         super().__init__(x, y, window=window)
+
+    @property
+    def metric(self):
+        return self._metric
+
+    @metric.setter
+    def metric(self, metric):
         self._metric = metric
-            
-    def __call__(self, x):
-        y = x * 0
-        for i, x_ in enumerate(x):
-            msk = np.abs(x_ - self._x) < self.window
-            y[i] = self._metric(self._y[msk])
+        self._fitted = None
+
+    def _key(self):
+        return (self._window, self._metric)
+
+    def window_bounds(self, x):
+        """Index bounds into the sorted data of the open windows |x_data - x| < window
+        """
+        return (np.searchsorted(self._xs, x - self.window, side='right'),
+                np.searchsorted(self._xs, x + self.window, side='left'))
+
+    def _evaluate(self, x):
+        order = np.argsort(x, kind='stable')
+        starts, ends = self.window_bounds(x[order])
+        y = np.empty(len(x))
+        y[order] = self._metric.windows(self._ys, starts, ends)
         
         return y
 
     
 class NormalSmoother(ABCSmoother):
-    def __init__(self, x, y, z_score=0, window=None):
+    """Gaussian kernel weighted mean of y with standard deviation `window`
+
+        Args:
+            x, y, np.array: data
+            window, numeric: kernel bandwidth
+            truncate, numeric: default None uses every point, otherwise only points within
+                     truncate * window of an evaluation point are weighted (found with the
+                     sorted index), at truncate=4 the dropped tail holds < 7e-5 of the kernel mass
+            chunk_size, int: maximum number of kernel weights held in memory at once,
+                     the evaluation grid is processed in chunks of that size
+            bins, int: default None is exact, otherwise data are linearly binned onto `bins`
+                     regular cells spanning data and evaluation points, convolved with the kernel by
+                     FFT and the result interpolated. Linear binning with cell width d changes any
+                     kernel weight by at most d ** 2 / 8 times the largest curvature of the kernel,
+                     pdf(0) * d ** 2 / (8 * window ** 2) ~ 0.05 * (d / window) ** 2 on the pdf scale,
+                     that is d ** 2 / (8 * window ** 2) = 0.125 * (d / window) ** 2 relative to the
+                     peak weight pdf(0). Interpolating the convolved sums between grid cells adds
+                     at most as much again, so each weight is off by at most 0.25 * (d / window) ** 2
+                     of the peak weight, under 2.5e-3 for d < window / 10.
+                     Runtime is O(len(x) + bins * log(bins)).
+    """
+    def __init__(self, x, y, z_score=0, window=None, truncate=None, chunk_size=2 ** 22, bins=None):
         super().__init__(x, y, window=window)
-    
-    def __call__(self, x):
-        _w = distributions.norm.pdf((x.reshape(1, -1) - self._x.reshape(-1, 1)) / self.window)
-        _w = _w / _w.sum(axis=0, keepdims=True)
-        
-        
-        return np.dot(self._y.reshape(1, -1), _w).ravel() #, _coun
+        assert truncate is None or truncate > 0
+        assert bins is None or bins > 2
+        self.truncate = truncate
+        self.chunk_size = chunk_size
+        self.bins = bins
+
+    def _key(self):
+        return (self._window, self.truncate, self.bins)
+
+    def _chunks(self, starts, ends):
+        """Split sorted evaluation points into runs whose kernel blocks fit in chunk_size
+        """
+        a = 0
+        while a < len(starts):
+            b = a + 1
+            while b < len(starts) and (ends[b] - starts[a]) * (b + 1 - a) <= self.chunk_size:
+                b += 1
+            yield a, b
+            a = b
+
+    def _binned(self, x):
+        from scipy.signal import fftconvolve
+        from scipy.stats import distributions
+
+        lo = min(self._xs[0], x.min())
+        hi = max(self._xs[-1], x.max())
+        grid = np.linspace(lo, hi, self.bins)
+        d = grid[1] - grid[0] if hi > lo else 1.
+        pos = (self._xs - lo) / d
+        i = np.minimum(pos.astype(np.int64), self.bins - 2)
+        f = pos - i
+        cnt = np.bincount(i, 1 - f, self.bins) + np.bincount(i + 1, f, self.bins)
+        sy = np.bincount(i, (1 - f) * self._ys, self.bins) + np.bincount(i + 1, f * self._ys, self.bins)
+
+        reach = (8 if self.truncate is None else self.truncate) * self.window
+        L = min(self.bins - 1, int(np.ceil(reach / d)))
+        kernel = distributions.norm.pdf(np.arange(-L, L + 1) * d / self.window)
+        num = fftconvolve(sy, kernel, mode='same')
+        den = fftconvolve(cnt, kernel, mode='same')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.interp(x, grid, num) / np.interp(x, grid, den)
+
+    def _evaluate(self, x):
+        if self.bins is not None:
+            return self._binned(x)
+
+        order = np.argsort(x, kind='stable')
+        xo = x[order]
+        if self.truncate is None:
+            starts = np.zeros(len(x), dtype=np.int64)
+            ends = np.full(len(x), len(self._xs))
+        else:
+            reach = self.truncate * self.window
+            starts = np.searchsorted(self._xs, xo - reach, side='left')
+            ends = np.searchsorted(self._xs, xo + reach, side='right')
+
+        y = np.empty(len(x))
+        for a, b in self._chunks(starts, ends):
+            lo, hi = starts[a], ends[b - 1]
+            z = (xo[a:b].reshape(1, -1) - self._xs[lo:hi].reshape(-1, 1)) / self.window
+            # the kernel's normalizing constant cancels in the weighted mean
+            _w = np.exp(-0.5 * z * z)
+            if self.truncate is not None:
+                _w[np.abs(z) > self.truncate] = 0
+            with np.errstate(invalid='ignore', divide='ignore'):
+                y[order[a:b]] = np.dot(self._ys[lo:hi], _w) / _w.sum(axis=0)
+
+        return y
@@ -0,0 +1,124 @@
+import json
+import zipfile
+
+import numpy as np
+
+_META = '__meta__'
+
+
+def _key(k):
+    return {'tuple': [_key(v) for v in k]} if isinstance(k, tuple) else k.item() if isinstance(k, np.generic) else k
+
+def _unkey(k):
+    return tuple(_unkey(v) for v in k['tuple']) if isinstance(k, dict) else k
+
+def _json(value):
+    return json.loads(json.dumps(value, default=lambda o: o.item() if isinstance(o, np.generic) else o.tolist()))
+
+def _encode(value, name, arrays):
+    """Kind of a leaf value and its arrays added to `arrays` under names starting with `name`"""
+    if isinstance(value, np.ndarray) and value.dtype.kind in 'biufcmM':
+        arrays[name] = value
+        return 'array'
+    if isinstance(value, (list, tuple, np.ndarray)):
+        if len(value) and all(isinstance(v, (np.ndarray, list)) for v in value):
+            parts = [np.asarray(v) for v in value]
+            if all(p.dtype.kind in 'biuf' for p in parts):
+                arrays[name] = np.concatenate(parts) if parts else np.zeros(0)
+                arrays[name + '.offsets'] = np.concatenate([[0], np.cumsum([len(p) for p in parts])]).astype(np.int64)
+                return 'ragged'
+        elif all(isinstance(v, str) for v in value):
+            arrays[name] = np.array(value, dtype=str)
+            return 'str'
+        else:
+            a = np.asarray(value)
+            if a.dtype.kind in 'biufcmM':
+                arrays[name] = a
+                return 'array'
+
+    return None
+
+def save(path, data):
+    """Save plot data (the nested dicts of lattice.qhistograms, box_plots, histogram2d,
+        batch_plots, ...) to one uncompressed .npz file at `path`
+
+        Every column is one array: numeric columns as they are, lists of arrays (patch
+        coordinates) concatenated with their offsets, strings as fixed width unicode. Keys and
+        other values are kept in a small JSON member. Numeric lists and arrays load back as
+        np.arrays, lists of arrays as lists of arrays, lists of strings as lists.
+    """
+    arrays = {}
+    leaves = []
+
+    def walk(d, keys):
+        for k, v in d.items():
+            if isinstance(v, dict):
+                walk(v, keys + [_key(k)])
+                continue
+            name = f'c{len(leaves)}'
+            kind = _encode(v, name, arrays)
+            leaves.append({'keys': keys + [_key(k)], 'kind': kind or 'json', 'name': name,
+                           **({'value': _json(v)} if kind is None else {})})
+
+    walk(data, [])
+    arrays[_META] = np.frombuffer(json.dumps(leaves).encode(), dtype=np.uint8)
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+def _members(path, mmap):
+    """Arrays of an .npz by member name, views of one read only memory map of the file when
+        mmap is True
+    """
+    out = {}
+    with zipfile.ZipFile(path) as z, open(path, 'rb') as f:
+        buf = np.memmap(f, dtype=np.uint8, mode='r') if mmap else None
+        for info in z.infolist():
+            name = info.filename[:-len('.npy')]
+            if not mmap or info.compress_type != zipfile.ZIP_STORED:
+                out[name] = np.load(z.open(info), allow_pickle=False)
+                continue
+            # local file header: fixed 30 bytes then file name and extra field
+            n_name, n_extra = buf[info.header_offset + 26:info.header_offset + 30].view('<u2')
+            f.seek(info.header_offset + 30 + int(n_name) + int(n_extra))
+            version = np.lib.format.read_magic(f)
+            read_header = (np.lib.format.read_array_header_1_0 if version == (1, 0)
+                           else np.lib.format.read_array_header_2_0)
+            shape, fortran, dtype = read_header(f)
+            out[name] = np.ndarray(shape, dtype=dtype, buffer=buf, offset=f.tell(), order='F' if fortran else 'C')
+
+    return out
+
+def load(path, mmap=True):
+    """Load plot data saved with save
+
+        Members are stored uncompressed, so numeric columns are mapped into memory in place
+        and processes serving the same file share one page cache copy.
+
+        Args:
+            mmap, bool: map numeric columns into memory (read only) instead of reading them
+    """
+    arrays = _members(path, mmap)
+    data = {}
+    for leaf in json.loads(bytes(arrays[_META]).decode()):
+        kind, name = leaf['kind'], leaf['name']
+        if kind == 'array':
+            value = arrays[name]
+        elif kind == 'ragged':
+            a, offsets = arrays[name], arrays[name + '.offsets']
+            lens = np.diff(offsets)
+            if len(lens) and (lens == lens[0]).all():
+                # rows of one 2d view are the cheapest way to many equal length views
+                value = list(a.reshape(len(lens), -1)) if lens[0] else [a[:0]] * len(lens)
+            else:
+                value = [a[i:j] for i, j in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+        elif kind == 'str':
+            value = arrays[name].tolist()
+        else:
+            value = leaf['value']
+        d = data
+        keys = [_unkey(k) for k in leaf['keys']]
+        for k in keys[:-1]:
+            d = d.setdefault(k, {})
+        d[keys[-1]] = value
+
+    return data
@@ -1,5 +1,7 @@
 import numpy as np
-from filigree.metrics import Quantile
+import pandas as pd
+from filigree.metrics import Quantile, MetricSet
+from filigree.profiling import profiled
 
 qmedian = Quantile(0.5, 'qmedian')
 
@@ -11,30 +13,277 @@ def frequency(x):
         
     return freq
 
-def calculate_quantiles(df, by, col, quantiles=(.25, .5, .75)):
-    quants = {f'q_{q * 1000:04.0f}': (col, Quantile(q)) for q in quantiles}
-    #return quants
-    return (df.groupby(by).agg(qmin=(col, min),
-                               qmax=(col, max),
-                               qmedian=(col, qmedian),
-                               mu=(col, np.mean),
-                               n_records=(col, len),
-                               **quants
-                              )
-           )
+def quantile_label(q):
+    return f'q_{q * 1000:04.0f}'
 
-def plural_multi_agg(dg, **kwargs):
+def sort_segments(codes, values, n_groups, weights=None):
+    """Sort values within groups given integer group codes (0 <= code < n_groups)
+
+        return: tuple (sorted_values, offsets), group i is sorted_values[offsets[i]:offsets[i + 1]];
+                 (sorted_values, offsets, sorted_weights) when weights are given
+    """
+    order = np.lexsort((values, codes))
+    offsets = np.zeros(n_groups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=n_groups), out=offsets[1:])
+    if weights is not None:
+        return values[order], offsets, weights[order]
+
+    return values[order], offsets
+
+def group_sort(keys, values, weights=None):
+    """Factorize group keys once and sort values within each group with a single lexsort
+
+        Args:
+            keys, array-like: group label of each record (records with null keys are dropped),
+                     or a DataFrame of several key columns grouped by their distinct rows
+                     (groups is then a MultiIndex)
+            values, array-like: numeric values (null values are dropped)
+            weights, array-like: default None, non-negative weight (e.g. count) of each record,
+                     records with null or zero weight are dropped
+
+        return:
+            tuple (groups, sorted_values, offsets) where the values of groups[i] are
+                 sorted_values[offsets[i]:offsets[i + 1]] in ascending order;
+                 (groups, sorted_values, offsets, sorted_weights) when weights are given
+    """
+    values = np.asarray(values, dtype=float)
+    if isinstance(keys, pd.DataFrame):
+        # several keys as df.groupby([...]): rows with any null key are dropped
+        valid = keys.notna().all(axis=1).to_numpy()
+        codes = np.full(len(keys), -1, dtype=np.int64)
+        codes[valid], groups = pd.factorize(pd.MultiIndex.from_frame(keys[valid]), sort=True)
+        groups = groups.set_names(list(keys.columns))
+    else:
+        codes, groups = pd.factorize(keys, sort=True)
+    keep = (codes >= 0) & ~np.isnan(values)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        assert not (weights < 0).any(), 'weights must be non-negative'
+        keep &= weights > 0
+    if not keep.all():
+        codes = codes[keep]
+        values = values[keep]
+        weights = None if weights is None else weights[keep]
+        # groups with no remaining values are removed so every segment is non-empty
+        present = np.bincount(codes, minlength=len(groups)) > 0
+        if not present.all():
+            codes = (np.cumsum(present) - 1)[codes]
+            groups = groups[present]
+
+    return (groups, ) + sort_segments(codes, values, len(groups), weights=weights)
+
+def segment_sum(values, offsets):
+    """Sum of every segment values[offsets[i]:offsets[i + 1]], empty segments sum to 0
+    """
+    sums = np.zeros(len(offsets) - 1)
+    nonempty = np.diff(offsets) > 0
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(values, offsets[:-1][nonempty])
+
+    return sums
+
+def segment_quantiles(sorted_values, offsets, quantiles, weights=None):
+    """Linearly interpolated quantiles (as numpy.quantile) of every sorted segment at once
+
+        Args:
+            sorted_values, np.array: values sorted within each segment
+            offsets, np.array(int): segment boundaries, segment i is sorted_values[offsets[i]:offsets[i + 1]]
+            quantiles, iterable(float): quantiles to read, 0 <= q <= 1
+            weights, np.array: default None, weight of each value (aligned with sorted_values)
+
+        return: np.array of shape (n_segments, n_quantiles), nan for empty segments
+    """
+    quantiles = np.asarray(quantiles, dtype=float).reshape(1, -1)
+    counts = np.diff(offsets).reshape(-1, 1)
+    if not len(sorted_values):
+        return np.full((len(counts), quantiles.shape[1]), np.nan)
+    if weights is not None:
+        return _weighted_segment_quantiles(sorted_values, offsets, quantiles, weights)
+
+    pos = offsets[:-1].reshape(-1, 1) + quantiles * np.maximum(counts - 1, 0)
+    lo = np.minimum(np.floor(pos).astype(np.int64), len(sorted_values) - 1)
+    hi = np.clip(offsets[1:].reshape(-1, 1) - 1, 0, None)
+    hi = np.minimum(lo + 1, hi)
+    vlo = sorted_values[lo]
+    qs = vlo + (sorted_values[hi] - vlo) * (pos - lo)
+
+    return np.where(counts > 0, qs, np.nan)
+
+def _weighted_segment_quantiles(sorted_values, offsets, quantiles, weights):
+    """segment_quantiles of values repeated by their weights, without repeating them
+
+        Rank k of a segment (0 <= k < its total weight) holds the value whose cumulative weight
+        first exceeds k, so integer weights give exactly numpy.quantile of the exploded values.
+    """
+    cum = np.cumsum(weights)
+    base = np.concatenate([[0.], cum])[offsets[:-1]].reshape(-1, 1)
+    totals = segment_sum(weights, offsets).reshape(-1, 1)
+    pos = quantiles * np.maximum(totals - 1, 0)
+    lo = np.floor(pos)
+    last = np.clip(offsets[1:].reshape(-1, 1) - 1, 0, None)
+    ilo = np.minimum(np.searchsorted(cum, base + lo, side='right'), last)
+    ihi = np.minimum(np.searchsorted(cum, base + lo + 1, side='right'), last)
+    vlo = sorted_values[ilo]
+    qs = vlo + (sorted_values[ihi] - vlo) * (pos - lo)
+
+    return np.where(totals > 0, qs, np.nan)
+
+def segment_min(sorted_values, offsets):
+    return segment_quantiles(sorted_values, offsets, [0.])[:, 0]
+
+def segment_max(sorted_values, offsets):
+    return segment_quantiles(sorted_values, offsets, [1.])[:, 0]
+
+def segment_mean(sorted_values, offsets, weights=None):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if weights is None:
+            return segment_sum(sorted_values, offsets) / np.diff(offsets)
+        return segment_sum(sorted_values * weights, offsets) / segment_sum(weights, offsets)
+
+def segment_std(sorted_values, offsets, ddof=1, weights=None):
+    counts = np.diff(offsets)
+    mu = segment_mean(sorted_values, offsets, weights=weights)
+    dev = (sorted_values - np.repeat(mu, counts)) ** 2
+    if weights is not None:
+        # frequency weights, as the std of the values repeated by their weights
+        dev, counts = dev * weights, segment_sum(weights, offsets)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sqrt(segment_sum(dev, offsets) / (counts - ddof))
+
+# named reductions that plural_multi_agg answers with columnar kernels on group sorted segments
+SEGMENT_REDUCTIONS = {'min': segment_min,
+                      'max': segment_max,
+                      'median': lambda v, o: segment_quantiles(v, o, [.5])[:, 0],
+                      'mean': segment_mean,
+                      'sum': segment_sum,
+                      'std': segment_std,
+                      'count': lambda v, o: np.diff(o)}
+
+def segment_summary(sorted_values, offsets, quantiles=(.25, .5, .75), weights=None):
+    """Min, max, median, mean, count and quantiles of every sorted segment,
+        with weights the count is the total weight
+
+        return: dict of column name to np.array with one entry per segment
+    """
+    qs = segment_quantiles(sorted_values, offsets, [0., 1., .5] + list(quantiles), weights=weights)
+    summary = {'qmin': qs[:, 0],
+               'qmax': qs[:, 1],
+               'qmedian': qs[:, 2],
+               'mu': segment_mean(sorted_values, offsets, weights=weights),
+               'n_records': np.diff(offsets) if weights is None else segment_sum(weights, offsets)}
+    for i, q in enumerate(quantiles):
+        summary[quantile_label(q)] = qs[:, i + 3]
+
+    return summary
+
+def _group_index(groups, by):
+    return groups if isinstance(groups, pd.MultiIndex) else pd.Index(groups, name=by)
+
+@profiled('aggregation')
+def calculate_quantiles(df, by, col, quantiles=(.25, .5, .75), weights=None):
+    """Summarize `col` by groups of `by`: qmin, qmax, qmedian, mu, n_records and a 'q_XXXX'
+        column per quantile. Groups are sorted once and all statistics are read from the
+        group offsets, rather than one groupby reduction per statistic.
+
+        by, str or list: group column(s), a list groups by their distinct rows (MultiIndex)
+        weights, str: default None, column of record weights (e.g. counts of pre-aggregated
+                 values), statistics are those of the records repeated by their weights and
+                 n_records is the total weight
+
+        n_records counts the non-null values of each group, groups without any are left out
     """
+    w = None
+    if weights is None:
+        groups, values, offsets = group_sort(df[by], df[col])
+    else:
+        groups, values, offsets, w = group_sort(df[by], df[col], weights=df[weights])
+
+    return pd.DataFrame(segment_summary(values, offsets, quantiles=quantiles, weights=w),
+                        index=_group_index(groups, by))
+
+@profiled('aggregation')
+def calculate_metrics(df, by, col, metrics, weights=None):
+    """Evaluate metrics (filigree.metrics instances) on `col` by groups of `by`, in place of
+        df.groupby(by).agg(**{m.__name__: (col, m) for m in metrics})
+
+        Groups are sorted once and the metrics share each group's sort and moments (see MetricSet)
+
+        weights, str: default None, column of record weights, see calculate_quantiles
+
+        return: pandas.DataFrame indexed by group with a column per metric __name__
+    """
+    w = None
+    if weights is None:
+        groups, values, offsets = group_sort(df[by], df[col])
+    else:
+        groups, values, offsets, w = group_sort(df[by], df[col], weights=df[weights])
+    metrics = metrics if isinstance(metrics, MetricSet) else MetricSet(*metrics)
+
+    return pd.DataFrame(metrics.segments(values, offsets, weights=w), index=_group_index(groups, by))
+
+def bin_features(df, features, bins=10):
+    """Bin every feature once into integer codes
+
+        Numeric features with more than `bins` distinct values are cut at their quantiles
+        (equal frequency bins), other features get a code per distinct value.
+
+        return:
+            tuple (codes, labels), codes np.array(int) of shape (n_records, n_features) with -1
+                 for null values, labels a list per feature of the label of each bin
+    """
+    codes = np.empty((len(df), len(features)), dtype=np.int64)
+    labels = []
+    for k, feature in enumerate(features):
+        s = df[feature]
+        if s.dtype.kind in 'biuf' and s.nunique() > bins:
+            v = s.to_numpy(dtype=float)
+            edges = np.unique(np.nanquantile(v, np.linspace(0, 1, bins + 1)))
+            c = np.clip(np.searchsorted(edges, v, side='right') - 1, 0, len(edges) - 2)
+            c[np.isnan(v)] = -1
+            labels.append([f'{lo:.3g} to {hi:.3g}' for lo, hi in zip(edges[:-1], edges[1:])])
+        else:
+            c, uniques = pd.factorize(s, sort=True)
+            labels.append([str(u) for u in uniques])
+        codes[:, k] = c
+
+    return codes, labels
+
+def _is_named_reduction(method):
+    return (isinstance(method, tuple) and len(method) == 2
+            and (method[1] in SEGMENT_REDUCTIONS or method[1] == 'size' or isinstance(method[1], float)))
+
+def plural_multi_agg(dg, **kwargs):
+    """Aggregate a grouped DataFrame into one column per keyword
     
         Args:
             dg, pd.Grouped DataFrame object
             kwargs: <new_col_name>=method(accesses columns in group dg) 
                    similar to the .assign method on DataFrame objects
+                   or <new_col_name>=(column, reduction) where reduction is a name in
+                   SEGMENT_REDUCTIONS, 'size' or a float quantile; these are computed for all
+                   groups at once from a single sort of each column rather than per group
     """
-    for i, (new_col, method) in enumerate(kwargs.items()):
-        if i == 0:
-            df = dg.apply(method).to_frame()
-            df.columns = [new_col]
-        df[new_col] = dg.apply(method)
+    index = dg.size().index
+    codes = dg.ngroup().to_numpy(dtype=float)
+
+    segments = {}
+    out = {}
+    for new_col, method in kwargs.items():
+        if not _is_named_reduction(method):
+            out[new_col] = dg.apply(method)
+            continue
+
+        col, reduction = method
+        if reduction == 'size':
+            out[new_col] = np.bincount(codes[codes >= 0].astype(np.int64), minlength=len(index))
+            continue
+        if col not in segments:
+            values = dg.obj[col].to_numpy(dtype=float)
+            keep = (codes >= 0) & ~np.isnan(values)
+            segments[col] = sort_segments(codes[keep].astype(np.int64), values[keep], len(index))
+        if isinstance(reduction, float):
+            out[new_col] = segment_quantiles(*segments[col], [reduction])[:, 0]
+        else:
+            out[new_col] = SEGMENT_REDUCTIONS[reduction](*segments[col])
         
-    return df
+    return pd.DataFrame(out, index=index)
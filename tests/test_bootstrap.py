@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from filigree.bootstrap import bootstrap_smoother
+from filigree.metrics import PortionInBounds, PortionInRadius, Quantile, SigmaOffset, SigmaRadius
+from filigree.smoothers import MetricSmoother
+
+
+def _smoother(metric, n=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(0, 10, n)
+    return MetricSmoother(x, np.sin(x) + rng.standard_normal(n), metric, window=.5)
+
+@pytest.mark.parametrize('metric', [SigmaOffset(1), SigmaRadius(2), PortionInBounds(-.5, 1), PortionInRadius(1)],
+                         ids=str)
+def test_weighted_windows_match_explicit_layout(metric):
+    smoother = _smoother(metric)
+    x = np.linspace(-1, 11, 60)
+    fast = bootstrap_smoother(smoother, x, n_replicates=50, chunk_size=2 ** 30)
+    metric._weighted_windows = False
+    explicit = bootstrap_smoother(smoother, x, n_replicates=50, chunk_size=2 ** 30)
+    for k in ('estimate', 'lower', 'upper'):
+        np.testing.assert_allclose(fast[k], explicit[k], rtol=1e-9, atol=1e-12, err_msg=k)
+    assert np.isnan(fast['estimate'][0]) and np.isfinite(fast['estimate'][30])
+
+@pytest.mark.parametrize('metric', [SigmaRadius(1), PortionInRadius(1), Quantile(.3)], ids=str)
+def test_windows_weights_match_repeated_values(metric):
+    rng = np.random.default_rng(1)
+    s = rng.standard_normal(200).round(1)
+    w = rng.integers(0, 3, 200)
+    starts = np.arange(0, 180, 7)
+    ends = starts + rng.integers(0, 20, len(starts))
+    expected = [metric(np.repeat(s[a:b], w[a:b])) if w[a:b].sum() else np.nan for a, b in zip(starts, ends)]
+    np.testing.assert_allclose(metric.windows(s, starts, ends, weights=w), expected, rtol=1e-9, atol=1e-12)
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+
+from filigree.cache import SummaryCache
+from filigree.fretwork import calculate_boxes
+from filigree.lattice import box_plots, qhistograms
+
+
+def _frame(n=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'g': rng.integers(0, 20, n), 'v': rng.standard_normal(n)})
+    df.loc[rng.random(n) < .1, 'v'] = np.nan
+    df.loc[df.g == 7, 'v'] = np.nan
+
+    return df
+
+def test_boxes_hit_equals_miss():
+    df = _frame()
+    cold = SummaryCache()
+    miss = cold.boxes(df, 'g', 'v')
+    assert cold.stats()['misses'] == 1
+
+    warm = SummaryCache()
+    warm.quantiles(df, 'g', 'v', quantiles=(.1, .25, .5, .75, .9))
+    hit = warm.boxes(df, 'g', 'v')
+    assert warm.stats()['hits'] == 1
+    pdt.assert_frame_equal(hit, miss)
+
+    # derived from a cached box table with another outlier_r
+    pdt.assert_frame_equal(cold.boxes(df, 'g', 'v', outlier_r=3), calculate_boxes(df, 'g', 'v', outlier_r=3))
+    assert cold.stats()['hits'] == 1
+
+def test_boxes_count_non_null():
+    df = _frame()
+    sf = calculate_boxes(df, 'g', 'v')
+    pdt.assert_series_equal(sf['n_records'], df.groupby('g')['v'].count()[lambda s: s > 0],
+                            check_names=False, check_dtype=False)
+
+def test_plots_do_not_depend_on_cache_state():
+    df = _frame()
+    cold = SummaryCache()
+    before = box_plots(df, 'g', 'v', cache=cold)
+    warm = SummaryCache()
+    qhistograms(df, 'g', 'v', cache=warm, quantiles=np.arange(.05, 1, .05))
+    after = box_plots(df, 'g', 'v', cache=warm)
+    for k in ('group', 'n', 'nlo', 'nho'):
+        assert before['boxes'][k] == after['boxes'][k]
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from filigree.fretwork import merge_cells
+from filigree.lattice import histogram2d
+
+PALETTE = ['#000000', '#444444', '#888888', '#cccccc']
+
+
+def _brute_force(codes):
+    """Rectangles of merge_cells built cell by cell: runs along rows, stacked while the run
+        below has the same columns and code
+    """
+    nrows, ncols = codes.shape
+    runs = set()
+    for i in range(nrows):
+        j = 0
+        while j < ncols:
+            k = j
+            while k < ncols and codes[i, k] == codes[i, j]:
+                k += 1
+            if codes[i, j] >= 0:
+                runs.add((i, j, k, codes[i, j]))
+            j = k
+    rects = set()
+    for i, j, k, c in runs:
+        if (i - 1, j, k, c) in runs:
+            continue
+        i1 = i + 1
+        while (i1, j, k, c) in runs:
+            i1 += 1
+        rects.add((i, i1, j, k, c))
+
+    return rects
+
+@pytest.mark.parametrize('shape, n_codes, seed', [((1, 1), 1, 0), ((4, 4), 1, 0), ((7, 5), 2, 1),
+                                                  ((20, 30), 3, 2), ((1, 12), 2, 3), ((12, 1), 2, 4)])
+def test_merge_cells_matches_brute_force(shape, n_codes, seed):
+    codes = np.random.default_rng(seed).integers(-1, n_codes, shape)
+    i0, i1, j0, j1, code, labels = merge_cells(codes)
+    assert set(zip(i0.tolist(), i1.tolist(), j0.tolist(), j1.tolist(), code.tolist())) == _brute_force(codes)
+
+    # the rectangles cover every kept cell exactly once, as labels says
+    cover = np.full(shape, -1)
+    for k in range(len(code)):
+        assert (cover[i0[k]:i1[k], j0[k]:j1[k]] == -1).all()
+        assert (codes[i0[k]:i1[k], j0[k]:j1[k]] == code[k]).all()
+        cover[i0[k]:i1[k], j0[k]:j1[k]] = k
+    assert (cover == labels).all()
+    assert ((labels >= 0) == (codes >= 0)).all()
+
+@pytest.mark.parametrize('shape', [(3, 4), (1, 1), (0, 0)])
+def test_merge_cells_nothing_kept(shape):
+    i0, i1, j0, j1, code, labels = merge_cells(np.full(shape, -1))
+    assert len(i0) == len(i1) == len(j0) == len(j1) == len(code) == 0
+    assert labels.shape == shape and (labels == -1).all()
+
+def test_histogram2d_merge_single_color():
+    # every cell has the most common color, only the background patch is left
+    x, y = [a.ravel() + .5 for a in np.meshgrid(np.arange(4), np.arange(4))]
+    for kwargs in [{'bins': 1}, {'bins': [np.arange(5), np.arange(5)]}]:
+        out = histogram2d(x, y, colors=PALETTE, group_largest=True, merge=True, **kwargs)['histogram2d']
+        assert out['x'].shape == (1, 4)
+        assert out['cells'].tolist() == [np.size(np.histogram2d(x, y, **kwargs)[0])]
+
+    out = histogram2d([], [], bins=4, colors=PALETTE, drop_empty=True, merge=True)['histogram2d']
+    assert out['x'].shape == (0, 4) and len(out['cells']) == 0
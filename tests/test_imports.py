@@ -0,0 +1,12 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_plot_data_does_not_import_bokeh_or_scipy():
+    code = ("import sys; import filigree; from filigree import qhistograms, box_plots; import filigree.smoothers; "
+            "print(sorted(m for m in sys.modules if m.split('.')[0] in ('bokeh', 'scipy')))")
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, text=True)
+    assert out.strip() == '[]', out
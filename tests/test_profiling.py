@@ -0,0 +1,31 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from filigree.profiling import Profile, profiled
+
+
+@profiled('geometry')
+def _inner(t):
+    time.sleep(t)
+
+@profiled('aggregation')
+def _outer(t):
+    time.sleep(t)
+    _inner(t)
+
+def test_self_seconds_exclude_nested_stages():
+    with Profile() as prof:
+        _outer(.05)
+    stages = prof.to_dict()
+    outer, inner = stages['aggregation'], stages['geometry']
+    assert outer['seconds'] >= .1
+    assert .05 <= outer['self_seconds'] < outer['seconds'] - .04
+    assert abs(inner['self_seconds'] - inner['seconds']) < 1e-9
+
+def test_threads_do_not_nest():
+    with Profile() as prof, ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(_inner, [.05] * 4))
+    records = prof.records
+    assert len(records) == 4
+    for r in records:
+        assert abs(r['self_seconds'] - r['seconds']) < 1e-9
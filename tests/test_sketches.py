@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+
+from filigree.fretwork import calculate_boxes
+from filigree.sketches import QuantileSketch
+from filigree.tools import calculate_quantiles, quantile_label
+
+QUANTILES = (.01, .1, .25, .5, .75, .9, .99)
+EXACT = ['qmin', 'qmax', 'mu', 'n_records']
+
+
+def _frame(n=200000, groups=10, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'g': rng.integers(0, groups, n), 'v': rng.lognormal(size=n)})
+    df.loc[rng.random(n) < .01, 'v'] = np.nan
+
+    return df
+
+def _chunks(df, k):
+    bounds = np.linspace(0, len(df), k + 1).astype(int)
+    return [df.iloc[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+def _rank_error(df, table, columns, quantiles):
+    """Largest distance of the estimated quantiles' ranks (fractions of the group) from the
+        requested quantiles
+    """
+    error = 0.
+    for g, s in df.dropna().groupby('g')['v']:
+        v = np.sort(s.to_numpy())
+        est = table.loc[g, columns].to_numpy(dtype=float)
+        lo = np.searchsorted(v, est, side='left') / len(v)
+        hi = np.searchsorted(v, est, side='right') / len(v)
+        error = max(error, np.max(np.maximum(lo - quantiles, quantiles - hi).clip(0)))
+
+    return error
+
+def test_quantiles_within_rank_error():
+    df = _frame()
+    exact = calculate_quantiles(df, 'g', 'v', quantiles=QUANTILES)
+    columns = [quantile_label(q) for q in QUANTILES]
+    for compression in (100, 200):
+        single = QuantileSketch('g', 'v', compression=compression).update(df).calculate_quantiles(QUANTILES)
+        chunked = (QuantileSketch('g', 'v', compression=compression).fit(_chunks(df, 50))
+                   .calculate_quantiles(QUANTILES))
+        for table in (single, chunked):
+            assert list(table.columns) == list(exact.columns)
+            pdt.assert_frame_equal(table[EXACT], exact[EXACT], check_names=False)
+        assert _rank_error(df, single, columns, np.array(QUANTILES)) < 1 / compression
+        assert _rank_error(df, chunked, columns, np.array(QUANTILES)) < 1.5 / compression
+
+def test_boxes_within_rank_error():
+    df = _frame()
+    sketched = QuantileSketch('g', 'v').fit(_chunks(df, 20)).calculate_boxes(outlier_r=2)
+    exact = calculate_boxes(df, 'g', 'v', outlier_r=2)
+    assert list(sketched.columns) == list(exact.columns)
+    pdt.assert_frame_equal(sketched[EXACT], exact[EXACT], check_names=False)
+    assert _rank_error(df, sketched, ['q1', 'q2', 'q3'], np.array([.25, .5, .75])) < 1.5 / 200
+
+def test_small_groups_exact():
+    df = _frame(n=1000, groups=50)
+    sketched = QuantileSketch('g', 'v').fit(_chunks(df, 7)).calculate_quantiles(QUANTILES)
+    pdt.assert_frame_equal(sketched, calculate_quantiles(df, 'g', 'v', quantiles=QUANTILES), check_names=False)
+
+def test_merge_matches_single_pass():
+    df = _frame()
+    quantiles = np.array(QUANTILES)
+    columns = [quantile_label(q) for q in QUANTILES]
+    # the halves hold different groups too
+    a, b = df[df.g < 7].iloc[::2], pd.concat([df[df.g < 7].iloc[1::2], df[df.g >= 7]])
+    merged = (QuantileSketch('g', 'v').fit(_chunks(a, 5))
+              .merge(QuantileSketch('g', 'v').fit(_chunks(b, 5))).calculate_quantiles(QUANTILES))
+    single = QuantileSketch('g', 'v').update(df).calculate_quantiles(QUANTILES)
+    pdt.assert_index_equal(merged.index, single.index)
+    pdt.assert_frame_equal(merged[['qmin', 'qmax', 'n_records']], single[['qmin', 'qmax', 'n_records']])
+    assert np.allclose(merged['mu'], single['mu'])
+    assert _rank_error(df, single, columns, quantiles) < 1 / 200
+    assert _rank_error(df, merged, columns, quantiles) < 1.5 / 200
@@ -0,0 +1,19 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from filigree.smoothers import QuantileSmoother
+
+
+def test_fit_warns_when_tol_is_not_reached():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0, 10, 5000)
+    noisy = QuantileSmoother(x, rng.standard_normal(5000), .5, window=.01)
+    with pytest.warns(RuntimeWarning, match='max_grid_size'):
+        noisy.fit(grid_size=16, tol=1e-6, max_grid_size=64)
+    assert noisy.error > 1e-6
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert QuantileSmoother(x, x, .5, window=1).fit().error <= 1e-3
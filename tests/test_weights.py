@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+
+from filigree.lattice import box_plots
+from filigree.metrics import (MetricSet, PortionInBounds, PortionInRadius, Quantile, QuantileRange,
+                              SigmaOffset, SigmaRadius)
+from filigree.tools import calculate_metrics, calculate_quantiles
+
+METRICS = [Quantile(.1), Quantile(.5), QuantileRange(.25, .75), SigmaOffset(-1), SigmaRadius(2),
+           PortionInBounds(-1, .5), PortionInRadius(1)]
+
+
+def _frame(n=2000, seed=0):
+    """Records with integer weights (counts, some 0) and the records repeated by them"""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'g': rng.integers(0, 6, n), 'v': rng.standard_normal(n).round(1),
+                       'w': rng.integers(0, 4, n)})
+    df.loc[rng.random(n) < .05, 'v'] = np.nan
+
+    return df, df.loc[df.index.repeat(df.w)].reset_index(drop=True)
+
+def test_calculate_quantiles_weights():
+    df, exploded = _frame()
+    quantiles = (.01, .25, .5, .75, .99)
+    weighted = calculate_quantiles(df, 'g', 'v', quantiles, weights='w')
+    pdt.assert_frame_equal(weighted, calculate_quantiles(exploded, 'g', 'v', quantiles), check_dtype=False)
+
+def test_calculate_metrics_weights():
+    df, exploded = _frame()
+    weighted = calculate_metrics(df, 'g', 'v', METRICS, weights='w')
+    pdt.assert_frame_equal(weighted, calculate_metrics(exploded, 'g', 'v', METRICS))
+
+@pytest.mark.parametrize('metric', METRICS, ids=str)
+def test_metric_weights(metric):
+    df, exploded = _frame()
+    s, w = df.v.dropna(), df.w[df.v.notna()]
+    expected = metric(exploded.v.dropna().values)
+    assert metric(s.values, weights=w.values) == pytest.approx(expected)
+    assert MetricSet(metric)(s.values, weights=w.values)[metric.__name__] == pytest.approx(expected)
+    assert np.isnan(metric(np.array([1., 2., 3.]), weights=np.zeros(3)))
+
+def test_box_plots_weights():
+    df, exploded = _frame()
+    weighted = box_plots(df, 'g', 'v', weights='w', jitter=False, layout='arrays')
+    expected = box_plots(exploded, 'g', 'v', jitter=False, layout='arrays')
+    for part in ('boxes', 'means'):
+        for k, v in expected[part].items():
+            np.testing.assert_allclose(weighted[part][k], v, err_msg=f'{part} {k}')
+
+    # one outlier point per weighted record, one per exploded record
+    out = weighted['outliers']
+    points = np.repeat(np.stack([out['group'], out['y']], axis=1), out['weight'], axis=0)
+    exp = expected['outliers']
+    np.testing.assert_array_equal(np.unique(points, axis=0),
+                                  np.unique(np.stack([exp['group'], exp['y']], axis=1), axis=0))
+    assert len(points) == len(exp['y'])